@@ -0,0 +1,284 @@
+"""An asyncio runtime for RSVPBot, enabled with RSVPBOT_RUNTIME=asyncio.
+
+The Zulip long-poll, replies to Zulip and the poller's schedule all run as
+coroutines on one event loop, so waiting on the network doesn't tie up a
+thread. Command logic (RSVP.process_message), the poller's database work and
+the outbox drainer are shared with the threaded runtime and are still
+synchronous, so they run on small, bounded executors.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import json
+import sys
+import traceback
+
+import aiohttp
+
+import atom
+import config
+import outbox
+import poller
+import tracing
+import zulip_util
+from bot import Bot, QueueProgress, thread_key
+
+# Zulip holds a long-poll open for about a minute before sending a heartbeat.
+LONG_POLL_TIMEOUT = 120
+
+class AsyncZulipClient:
+    """The handful of Zulip API calls the bot makes while running, over aiohttp."""
+    def __init__(self, email, api_key, site):
+        self.api_root = site.rstrip('/') + '/api/v1/'
+        self.auth = aiohttp.BasicAuth(email, api_key)
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(auth=self.auth, timeout=aiohttp.ClientTimeout(total=LONG_POLL_TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def call(self, method, endpoint, data):
+        if method == 'GET':
+            kwargs = {'params': data}
+        else:
+            kwargs = {'data': data}
+
+        async with self.session.request(method, self.api_root + endpoint, **kwargs) as r:
+            return await r.json(content_type=None)
+
+    async def register(self, event_types, narrow=None):
+        return await self.call('POST', 'register', {
+            'event_types': json.dumps(event_types),
+            'narrow': json.dumps(narrow or []),
+        })
+
+    async def get_events(self, queue_id, last_event_id):
+        return await self.call('GET', 'events', {'queue_id': queue_id, 'last_event_id': last_event_id})
+
+    async def send_message(self, message):
+        return await self.call('POST', 'messages', message)
+
+
+class AsyncBot(Bot):
+    """Runs the same commands as Bot, driven by an asyncio event loop.
+
+    Like Bot, messages from the same Zulip thread are handled strictly in
+    order and messages from different threads are handled concurrently. At
+    most worker_pool_size * worker_queue_depth messages are in flight at
+    once; after that, the bot stops reading from Zulip until some finish.
+    """
+    def __init__(self, running, zulip_username, zulip_api_key, key_word, subscribed_streams=None, zulip_site=None):
+        super().__init__(running, zulip_username, zulip_api_key, key_word, subscribed_streams, zulip_site)
+        self.async_client = AsyncZulipClient(zulip_username, zulip_api_key, zulip_site or config.zulip_site)
+        self.executor = ThreadPoolExecutor(config.worker_pool_size, thread_name_prefix='commands')
+        self.db_executor = ThreadPoolExecutor(1, thread_name_prefix='bot-state')
+        self.tails = {}
+        self.slots = None
+
+    def make_dispatcher(self):
+        # dispatch() schedules messages on the event loop instead.
+        return None
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.db_executor.shutdown()
+
+    async def run(self):
+        self.slots = asyncio.Semaphore(config.worker_pool_size * config.worker_queue_depth)
+
+        async with self.async_client:
+            try:
+                await self.listen()
+            finally:
+                await asyncio.gather(*self.tails.values(), return_exceptions=True)
+
+                if self.progress is not None:
+                    await asyncio.get_running_loop().run_in_executor(self.db_executor, self.save_progress, self.progress)
+
+    async def listen(self):
+        """Like Bot.listen, resumes the saved Zulip event queue if it hasn't expired,
+        and only saves progress past messages that have been handled."""
+        loop = asyncio.get_running_loop()
+        queue = await loop.run_in_executor(self.db_executor, self.load_queue)
+        self.progress = QueueProgress(*queue) if queue else None
+
+        while True:
+            try:
+                if self.progress is None:
+                    res = await self.async_client.register(self.event_types, self.narrow)
+
+                    if res['result'] != 'success':
+                        if not self.narrow_rejected(res):
+                            print("Server returned error:\n{}".format(res['msg']))
+                            await asyncio.sleep(1)
+                        continue
+
+                    await loop.run_in_executor(self.db_executor, self.subscribe_to_streams)
+                    self.progress = QueueProgress(res['queue_id'], res['last_event_id'])
+                    await loop.run_in_executor(self.db_executor, self.save_progress, self.progress)
+
+                queue_id, last_event_id = self.progress.queue_id, self.progress.last_fetched
+                res = await self.async_client.get_events(queue_id, last_event_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                print("Connection error fetching events:\n{}".format(traceback.format_exc()))
+                await asyncio.sleep(1)
+                continue
+
+            if res['result'] != 'success':
+                if res.get('code') == 'BAD_EVENT_QUEUE_ID':
+                    print("Zulip event queue {} expired, registering a new one".format(queue_id))
+                    self.progress = None
+                else:
+                    await asyncio.sleep(1)
+                continue
+
+            for event in res['events']:
+                try:
+                    await self.process_async(event)
+                except Exception:
+                    # Skip it, so it isn't fetched again forever.
+                    print("Error processing event {}:\n{}".format(event['id'], traceback.format_exc()))
+
+                self.progress.fetched(event['id'])
+
+            await loop.run_in_executor(self.db_executor, self.save_progress, self.progress)
+
+    async def process_async(self, event):
+        loop = asyncio.get_running_loop()
+
+        if event['type'] == 'message' and self.might_be_command(event['message']):
+            message = event['message']
+
+            if await loop.run_in_executor(self.db_executor, self.processed.first_time, message.get('id')):
+                await self.dispatch(self.progress, event)
+        elif event['type'] in ('stream', 'subscription'):
+            await loop.run_in_executor(self.db_executor, self.process_stream_event, event)
+
+    async def dispatch(self, progress, event):
+        await self.slots.acquire()
+        progress.started(event['id'])
+
+        key = thread_key(event['message'])
+        task = asyncio.create_task(self.respond_after(self.tails.get(key), progress, event))
+        task.add_done_callback(functools.partial(self.finished, key))
+        self.tails[key] = task
+
+    def finished(self, key, task):
+        self.slots.release()
+
+        if self.tails.get(key) is task:
+            del self.tails[key]
+
+    async def respond_after(self, previous, progress, event):
+        message = event['message']
+
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        with tracing.trace('message', message_id=message.get('id')):
+            try:
+                # The command runs on another thread, in this task's trace.
+                loop = asyncio.get_running_loop()
+                context = contextvars.copy_context()
+                replies = await loop.run_in_executor(self.executor, context.run, self.handle, message)
+
+                for reply in replies:
+                    if reply:
+                        with tracing.span('zulip', 'send_message'):
+                            await self.async_client.send_message(zulip_util.outgoing_message(reply))
+            except Exception:
+                print(traceback.format_exc())
+
+        # Not in a finally: a message cancelled at shutdown hasn't been handled.
+        progress.finished(event['id'])
+
+
+async def run_poller_async(running, jobs, executor):
+    loop = asyncio.get_running_loop()
+
+    while running.value:
+        await loop.run_in_executor(executor, jobs.run_due)
+        # Wake up at least once a second, in case a job was asked to run early.
+        await asyncio.sleep(min(jobs.seconds_until_next(), 1))
+
+async def run_outbox_async(running, executor):
+    loop = asyncio.get_running_loop()
+
+    while running.value:
+        await loop.run_in_executor(executor, outbox.drain_or_wait)
+
+async def main(running, coroutines):
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+
+    while running.value and not any(task.done() for task in tasks):
+        await asyncio.sleep(1)
+
+    for task in tasks:
+        task.cancel()
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+def run_async(running, role='all'):
+    """Runs the role's coroutines until shutdown, restarting the event loop if one crashes.
+
+    The bot, the poller's schedule, the executors and the refresh listener
+    are made once and kept across restarts, so a restart doesn't subscribe to
+    every stream again or leave threads and connections behind.
+    """
+    bot = jobs = None
+    executors = []
+    # Stops the refresh listener once we're done, however that happens.
+    listening = atom.Atom(True)
+
+    if role in ('all', 'bot'):
+        bot = AsyncBot(
+            running,
+            config.zulip_username,
+            config.zulip_api_key,
+            config.key_word,
+            [],
+            config.zulip_site
+        )
+        outbox_executor = ThreadPoolExecutor(1, thread_name_prefix='outbox')
+        executors.append(outbox_executor)
+
+    if role in ('all', 'poller'):
+        jobs = poller.make_scheduler()
+        # A single thread, so the poller's jobs never overlap.
+        poller_executor = ThreadPoolExecutor(1, thread_name_prefix='poller')
+        executors.append(poller_executor)
+        poller.listen_for_refreshes(listening, jobs)
+
+    try:
+        while running.value:
+            coroutines = []
+
+            if bot is not None:
+                coroutines += [bot.run(), run_outbox_async(running, outbox_executor)]
+
+            if jobs is not None:
+                coroutines.append(run_poller_async(running, jobs, poller_executor))
+
+            try:
+                asyncio.run(main(running, coroutines))
+            except Exception:
+                print(traceback.format_exc())
+    finally:
+        listening.value = False
+
+        if bot is not None:
+            bot.shutdown()
+
+        for executor in executors:
+            executor.shutdown()
+
+    print("Quitting bot")
+    sys.exit()
@@ -0,0 +1,88 @@
+"""Times the hot events queries with and without the thread and created_at indexes.
+
+Builds two temporary copies of the events table filled with the same fake
+events (a million by default): one with only the original primary key and
+recurse_id constraints, and one with every index on the events table. Nothing
+is written to the real events table, and the temporary tables go away when
+the script exits.
+
+Run from the repository root, after `alembic upgrade head`:
+
+    python benchmarks/indexes.py [number_of_events]
+"""
+# Do this early in case anything depends on .env
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv())
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+import models
+
+# About 1 in 10 events is tracked in a thread, and the last 1,000 are upcoming.
+POPULATE = """
+INSERT INTO {table} (recurse_id, created_at, created_by, url, timezone, start_time, end_time, title, stream, subject)
+SELECT
+  i,
+  now() + (i - :n + 1000) * interval '1 hour' - interval '7 days',
+  'Someone',
+  'https://www.recurse.com/calendar/' || i,
+  'America/New_York',
+  now() + (i - :n + 1000) * interval '1 hour',
+  now() + (i - :n + 1000) * interval '1 hour' + interval '1 hour',
+  'Event ' || i,
+  CASE WHEN i % 10 = 0 THEN 'stream-' || (i % 100) END,
+  CASE WHEN i % 10 = 0 THEN 'topic-' || i END
+FROM generate_series(1, :n) AS i
+"""
+
+QUERIES = [
+    ("event_exists, count() > 0",
+     "SELECT count(*) FROM {table} WHERE stream = :stream AND subject = :subject"),
+    ("event_exists, EXISTS",
+     "SELECT EXISTS (SELECT 1 FROM {table} WHERE stream = :stream AND subject = :subject)"),
+    ("event for a thread",
+     "SELECT * FROM {table} WHERE stream = :stream AND subject = :subject LIMIT 1"),
+    ("events_cursor fallback",
+     "SELECT * FROM {table} ORDER BY created_at DESC LIMIT 1"),
+    ("update_tracked_events",
+     "SELECT * FROM {table} WHERE stream IS NOT NULL AND subject IS NOT NULL AND start_time >= now()"),
+]
+
+def build(conn, table, n, with_indexes):
+    if with_indexes:
+        conn.execute(text("CREATE TEMP TABLE {} (LIKE events INCLUDING DEFAULTS INCLUDING INDEXES)".format(table)))
+    else:
+        conn.execute(text("CREATE TEMP TABLE {} (LIKE events INCLUDING DEFAULTS)".format(table)))
+        conn.execute(text("ALTER TABLE {} ADD PRIMARY KEY (id), ADD UNIQUE (recurse_id)".format(table)))
+
+    conn.execute(text(POPULATE.format(table=table)), {'n': n})
+    conn.execute(text("ANALYZE {}".format(table)))
+
+def time_query(conn, sql, params, runs=50):
+    start = time.perf_counter()
+    for _ in range(runs):
+        conn.execute(text(sql), params).fetchall()
+    return (time.perf_counter() - start) / runs * 1000
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    params = {'stream': 'stream-50', 'subject': 'topic-{}'.format(n // 2 - (n // 2) % 100 + 50)}
+
+    models.engine.echo = False
+
+    with models.engine.connect() as conn:
+        print("Building two tables with {:,} events each...".format(n))
+        build(conn, 'bench_events_before', n, with_indexes=False)
+        build(conn, 'bench_events_after', n, with_indexes=True)
+
+        print("{:<28} {:>14} {:>14}".format("query", "before (ms)", "after (ms)"))
+        for name, sql in QUERIES:
+            before = time_query(conn, sql.format(table='bench_events_before'), params)
+            after = time_query(conn, sql.format(table='bench_events_after'), params)
+            print("{:<28} {:>14.3f} {:>14.3f}".format(name, before, after))
@@ -0,0 +1,83 @@
+"""Measures how fast events can be rendered for Zulip, with and without Event's render cache.
+
+Each event is rendered the way the bot does over its life: an announcement,
+a summary and a change notice, each with the event's time and thread link.
+The "before" numbers re-render on every access, like Event did before it
+remembered rendered values. Events are built in memory; nothing touches the
+database.
+
+Run from the repository root:
+
+    python benchmarks/render.py [number_of_events]
+"""
+# Do this early in case anything depends on .env
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv())
+
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import zulip_util
+
+TIMEZONES = ['America/New_York', 'America/Los_Angeles', 'Europe/London', 'Asia/Kolkata']
+
+def make_events(n):
+    start = datetime.datetime(2017, 5, 17, 21, tzinfo=datetime.timezone.utc)
+
+    return [
+        models.Event(
+            recurse_id=i,
+            created_by='Someone',
+            url='https://www.recurse.com/calendar/{}'.format(i),
+            timezone=TIMEZONES[i % len(TIMEZONES)],
+            start_time=start + datetime.timedelta(hours=i),
+            end_time=start + datetime.timedelta(hours=i + 2),
+            title='Event {}'.format(i),
+            stream='stream-{}'.format(i % 100),
+            subject='topic-{}'.format(i),
+        )
+        for i in range(n)
+    ]
+
+def render(events):
+    for event in events:
+        zulip_util.announce_message(event)
+        "{} {}".format(event.timestamp(), event.zulip_link())
+        "The time has changed: " + event.timestamp()
+
+def with_cache(events):
+    # Start from nothing rendered, like events that were just loaded.
+    for event in events:
+        event.forget_rendered()
+
+    render(events)
+
+def without_cache(events):
+    original = models.Event.rendered
+    models.Event.rendered = lambda self, key, render: render()
+
+    try:
+        render(events)
+    finally:
+        models.Event.rendered = original
+
+def events_per_second(f, events, repeat=5):
+    best = min(timeit.repeat(lambda: f(events), repeat=repeat, number=1))
+    return len(events) / best
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    events = make_events(n)
+
+    before = events_per_second(without_cache, events)
+    after = events_per_second(with_cache, events)
+
+    print("Rendering {:,} events".format(n))
+    print("before:   {:>12,.0f} events/sec".format(before))
+    print("after:    {:>12,.0f} events/sec".format(after))
+    print("speedup:  {:>12.1f}x".format(after / before))
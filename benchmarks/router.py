@@ -0,0 +1,64 @@
+"""Measures how many lines per second RSVP can route to a command.
+
+Compares the linear scan RSVP.route_internal used to do (build the key word
+regex, then re.match every command's pattern string in order) with
+CommandRouter. Only matching is timed; no commands are executed.
+
+Run from the repository root:
+
+    python benchmarks/router.py
+"""
+# Do this early in case anything depends on .env
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv())
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rsvp
+
+LINES = [
+    'rsvp yes',
+    'rsvp no',
+    'rsvp hell yes!',
+    'rsvp nah, busy',
+    'rsvp summary',
+    'rsvp ping see you all there',
+    'rsvp init https://www.recurse.com/calendar/123',
+    'rsvp move http://testhost/#narrow/stream/a/subject/b',
+    'rsvp help',
+    'rsvp set limit 5',
+    'rsvp yesterday',
+    'Looking forward to this!',
+]
+
+def linear(bot, line):
+    if re.match(r'^{}'.format(bot.key_word), line, flags=re.I):
+        for command in bot.command_list:
+            matches = re.match(command.regex, line, flags=re.DOTALL | re.I)
+            if matches:
+                return command, matches
+    return None, None
+
+def routed(bot, line):
+    if bot.router.is_command(line):
+        return bot.router.match(line)
+    return None, None
+
+def lines_per_second(f, bot, repeat=5, number=2000):
+    best = min(timeit.repeat(lambda: [f(bot, line) for line in LINES], repeat=repeat, number=number))
+    return number * len(LINES) / best
+
+if __name__ == '__main__':
+    bot = rsvp.RSVP('rsvp')
+
+    before = lines_per_second(linear, bot)
+    after = lines_per_second(routed, bot)
+
+    print("linear scan:    {:>12,.0f} lines/sec".format(before))
+    print("CommandRouter:  {:>12,.0f} lines/sec".format(after))
+    print("speedup:        {:>12.1f}x".format(after / before))
@@ -1,11 +1,18 @@
 #! /usr/local/bin/python
 import os
+import re
 import sys
+import threading
+import time
+import traceback
 import zulip
 
 import rsvp
 import config
 import zulip_util
+import tracing
+from dedup import ProcessedMessages
+from dispatcher import Dispatcher
 
 import models
 
@@ -14,13 +21,27 @@ class Bot():
         an optional caption or list of captions, and a list of the zulip streams it should be active in.
         it then posts a caption and a randomly selected gif in response to zulip messages.
      """
+    event_types = ['message', 'stream', 'subscription']
+
     def __init__(self, running, zulip_username, zulip_api_key, key_word, subscribed_streams=None, zulip_site=None):
         self.running = running
+        self.email = zulip_username
         self.key_word = key_word.lower()
+        # Zulip only narrows event queues by stream, topic, sender and "is:"
+        # operators, so by default we get every message and might_be_command()
+        # does the filtering. See config.zulip_search_narrow.
+        self.narrow = [['search', self.key_word]] if config.zulip_search_narrow else []
+        self.command_filter = command_filter(key_word)
         self.subscribed_streams = subscribed_streams or []
         self.client = zulip.Client(zulip_username, zulip_api_key, site=zulip_site)
-        self.subscriptions = self.subscribe_to_streams()
+        self.subscriptions = self.get_subscribed_stream_names()
         self.rsvp = rsvp.RSVP(key_word)
+        self.dispatcher = self.make_dispatcher()
+        self.processed = ProcessedMessages(config.dedup_cache_size, config.dedup_ttl, config.dedup_persist)
+        self.progress = None
+
+    def make_dispatcher(self):
+        return Dispatcher(self.respond_to_event, config.worker_pool_size, config.worker_queue_depth)
 
     @property
     def streams(self):
@@ -40,30 +61,230 @@ class Bot():
         else:
             raise RuntimeError('check yo auth')
 
+    def get_subscribed_stream_names(self):
+        """Call Zulip API to get the names of the streams the bot is already subscribed to."""
+        response = self.client.get_subscriptions()
+        if response['result'] == 'success':
+            return {stream['name'] for stream in response['subscriptions']}
+        else:
+            raise RuntimeError('check yo auth')
+
     def subscribe_to_streams(self):
-        """Subscribes to zulip streams."""
-        self.client.add_subscriptions(self.streams)
+        """Subscribes to the zulip streams the bot isn't subscribed to yet.
+
+        Without subscribed_streams this lists every stream in the realm, so
+        it's only done when a new event queue is registered. A resumed queue
+        still has the events for streams created while the bot was away,
+        which process_stream_event subscribes to.
+        """
+        missing = [stream for stream in self.streams if stream['name'] not in self.subscriptions]
+
+        if missing:
+            self.client.add_subscriptions(missing)
+            self.subscriptions |= {stream['name'] for stream in missing}
+
+    def process_stream_event(self, event):
+        """Keeps self.subscriptions up to date, and joins new streams as they are created."""
+        names = {stream['name'] for stream in event.get('streams', event.get('subscriptions', []))}
+
+        if event['type'] == 'subscription' and event['op'] == 'add':
+            self.subscriptions |= names
+        elif event['type'] == 'subscription' and event['op'] == 'remove':
+            self.subscriptions -= names
+        elif event['type'] == 'stream' and event['op'] == 'create' and not self.subscribed_streams:
+            missing = names - self.subscriptions
+
+            if missing:
+                self.client.add_subscriptions([{'name': name} for name in sorted(missing)])
+                self.subscriptions |= missing
 
     def process(self, event):
         if not self.running.value:
             print("Quitting bot")
             sys.exit()
 
-        if event['type'] == 'message':
+        if event['type'] == 'message' and self.might_be_command(event['message']):
+            message = event['message']
+
+            if self.processed.first_time(message.get('id')):
+                self.progress.started(event['id'])
+                self.dispatcher.submit(thread_key(message), (self.progress, event))
+        elif event['type'] in ('stream', 'subscription'):
+            self.process_stream_event(event)
+
+    def might_be_command(self, message):
+        """False if no line of the message starts with the key word.
+
+        Zulip can't filter an event queue by message content, so this is what
+        keeps messages that aren't commands from costing a worker, a dedup
+        check or a database session.
+        """
+        return bool(self.command_filter.search(message['content']))
+
+    def respond_to_event(self, item):
+        progress, event = item
+
+        try:
             self.respond(event['message'])
+        finally:
+            progress.finished(event['id'])
 
     def respond(self, message):
         """Now we have an event dict, we should analyze it completely."""
 
-        replies = self.rsvp.process_message(message)
+        with tracing.trace('message', message_id=message.get('id')):
+            replies = self.handle(message)
+
+            for reply in replies:
+                if reply:
+                    zulip_util.send_message(reply, self.client)
+
+    def handle(self, message):
+        """Runs the commands in a message and returns the replies."""
+        with models.session_scope('message'):
+            return self.rsvp.process_message(message)
+
+    def load_queue(self):
+        return models.load_zulip_queue(self.email)
+
+    def save_queue(self, queue_id, last_event_id):
+        models.save_zulip_queue(self.email, queue_id, last_event_id)
+
+    def save_progress(self, progress):
+        self.save_queue(progress.queue_id, progress.last_handled())
+
+    def register(self):
+        """Registers a new Zulip event queue and saves it so it can be resumed after a restart."""
+        while True:
+            res = self.client.register(self.event_types, self.narrow)
+
+            if res['result'] == 'success':
+                # After registering, so streams created in between reach the new queue.
+                self.subscribe_to_streams()
+                self.save_queue(res['queue_id'], res['last_event_id'])
+                return res['queue_id'], res['last_event_id']
+
+            if not self.narrow_rejected(res):
+                print("Server returned error:\n{}".format(res['msg']))
+                time.sleep(1)
+
+    def narrow_rejected(self, res):
+        """Drops the narrow if Zulip refused to register a queue with it.
 
-        for reply in replies:
-            if reply:
-                zulip_util.send_message(reply, self.client)
+        Returns True if the registration should be retried right away. Without
+        a narrow we receive every message, and might_be_command() does the
+        filtering instead.
+        """
+        if not self.narrow or res.get('code') != 'BAD_REQUEST':
+            return False
+
+        print("Zulip couldn't register a queue narrowed to {} ({}), filtering messages locally instead".format(self.narrow, res['msg']))
+        self.narrow = []
+        return True
+
+    def listen(self):
+        """Long-polls Zulip for events and calls self.process() on each one.
+
+        Resumes the queue saved by the last run if Zulip still has it, so
+        messages sent while the bot was restarting aren't lost. A new queue is
+        only registered when Zulip says the saved one has expired.
+
+        The saved last_event_id only moves past messages once they've been
+        handled, so a restart gets the ones still waiting for a worker again.
+        """
+        queue = self.load_queue()
+        self.progress = QueueProgress(*queue) if queue else None
+
+        while True:
+            if self.progress is None:
+                self.progress = QueueProgress(*self.register())
+
+            queue_id, last_event_id = self.progress.queue_id, self.progress.last_fetched
+
+            try:
+                res = self.client.get_events(queue_id=queue_id, last_event_id=last_event_id)
+            except Exception:
+                print("Error fetching events:\n{}".format(traceback.format_exc()))
+                time.sleep(1)
+                continue
+
+            if res['result'] != 'success':
+                if res.get('code') == 'BAD_EVENT_QUEUE_ID':
+                    print("Zulip event queue {} expired, registering a new one".format(queue_id))
+                    self.progress = None
+                else:
+                    time.sleep(1)
+                continue
+
+            for event in res['events']:
+                try:
+                    self.process(event)
+                except Exception:
+                    # Skip it, so it isn't fetched again forever.
+                    print("Error processing event {}:\n{}".format(event['id'], traceback.format_exc()))
+
+                self.progress.fetched(event['id'])
+
+            self.save_progress(self.progress)
 
     def main(self):
         """Blocking call that runs forever. Calls self.respond() on every event received."""
-        self.client.call_on_each_event(self.process, ['message', 'realm_user'])
+        self.dispatcher.start()
+
+        try:
+            self.listen()
+        finally:
+            self.dispatcher.stop()
+
+            if self.progress is not None:
+                self.save_progress(self.progress)
+
+
+class QueueProgress:
+    """How far the bot has got through a Zulip event queue.
+
+    Zulip resends every event after the last_event_id we resume from, so the
+    id we save must not pass a message that's still waiting for a worker or
+    being handled by one. last_handled() is the id just before the oldest
+    such message, or the last event fetched if there are none.
+    """
+    def __init__(self, queue_id, last_event_id):
+        self.queue_id = queue_id
+        self.last_fetched = last_event_id
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    def fetched(self, event_id):
+        self.last_fetched = max(self.last_fetched, event_id)
+
+    def started(self, event_id):
+        with self.lock:
+            self.in_flight.add(event_id)
+
+    def finished(self, event_id):
+        with self.lock:
+            self.in_flight.discard(event_id)
+
+    def last_handled(self):
+        with self.lock:
+            if self.in_flight:
+                return min(self.in_flight) - 1
+
+            return self.last_fetched
+
+def command_filter(key_word):
+    """A regex that finds messages with a line RSVP.route would send to a command.
+
+    route() strips each line and then matches the key word at its start.
+    """
+    return re.compile(r'^[^\S\n]*{}'.format(key_word), flags=re.I | re.M)
+
+def thread_key(message):
+    """Messages with the same key are handled in the order they were received."""
+    if message['type'] == 'private':
+        return ('private', message['sender_email'])
+    else:
+        return (message['display_recipient'], message['subject'])
 
 
 """ The Customization Part!
@@ -16,3 +16,120 @@ rc_api_root = rc_root + '/api/v1'
 
 rsvpbot_stream = os.getenv('RSVPBOT_STREAM', 'RSVPs')
 rsvpbot_announce_subject = os.getenv('RSVPBOT_ANNOUNCE_SUBJECT', 'announce')
+
+# Zulip can't filter event queues by message content: every Zulip server we
+# know of rejects a 'search' narrow, and the bot then registers again without
+# it. Set RSVPBOT_ZULIP_SEARCH_NARROW to try it anyway, for a server that
+# accepts it.
+zulip_search_narrow = os.getenv('RSVPBOT_ZULIP_SEARCH_NARROW', '').lower() not in ('', '0', 'false', 'no')
+
+# Messages from the same Zulip thread are always handled in order, but
+# different threads are handled in parallel by this many workers.
+worker_pool_size = int(os.getenv('RSVPBOT_WORKERS', 4))
+worker_queue_depth = int(os.getenv('RSVPBOT_WORKER_QUEUE_DEPTH', 100))
+
+# The poller asks RC for tracked events rc_ids_per_request ids at a time,
+# making up to rc_max_concurrent_requests requests at once.
+rc_ids_per_request = int(os.getenv('RSVPBOT_RC_IDS_PER_REQUEST', 100))
+rc_max_concurrent_requests = int(os.getenv('RSVPBOT_RC_MAX_CONCURRENT_REQUESTS', 4))
+
+# Which parts of RSVPBot this process runs: 'bot' (the Zulip bot and the
+# outbox drainer), 'poller', or 'all' of them. Overridden by the first
+# argument to rsvpbot.py.
+role = os.getenv('RSVPBOT_ROLE', 'all')
+
+# 'threads' runs the bot and the poller on their own threads. 'asyncio' runs
+# the Zulip long-poll and the poller's schedule on a single event loop.
+runtime = os.getenv('RSVPBOT_RUNTIME', 'threads')
+
+# Where to write tracing spans as JSON lines ('-' for stdout). Off if unset.
+trace_file = os.getenv('RSVPBOT_TRACE_FILE')
+
+# Zulip can deliver the same event twice when the long-poll reconnects.
+# Message ids seen in the last dedup_ttl seconds are skipped. Set
+# RSVPBOT_DEDUP_PERSIST to also record them in Postgres, across restarts.
+dedup_cache_size = int(os.getenv('RSVPBOT_DEDUP_CACHE_SIZE', 10000))
+dedup_ttl = int(os.getenv('RSVPBOT_DEDUP_TTL', 24 * 60 * 60))
+dedup_persist = os.getenv('RSVPBOT_DEDUP_PERSIST', '').lower() not in ('', '0', 'false', 'no')
+
+# How many (stream, subject) -> event lookups to keep in memory, and for how
+# many seconds.
+thread_cache_size = int(os.getenv('RSVPBOT_THREAD_CACHE_SIZE', 10000))
+thread_cache_ttl = int(os.getenv('RSVPBOT_THREAD_CACHE_TTL', 300))
+
+# Zulip messages and RC updates caused by database changes are written to the
+# outbox table and sent by a background drainer, outbox_batch_size at a time.
+# Failed sends are retried after outbox_retry_delay seconds, doubling each
+# time up to outbox_max_retry_delay, and given up on after outbox_max_attempts.
+outbox_batch_size = int(os.getenv('RSVPBOT_OUTBOX_BATCH_SIZE', 50))
+outbox_poll_interval = float(os.getenv('RSVPBOT_OUTBOX_POLL_INTERVAL', 1))
+outbox_max_attempts = int(os.getenv('RSVPBOT_OUTBOX_MAX_ATTEMPTS', 10))
+outbox_retry_delay = float(os.getenv('RSVPBOT_OUTBOX_RETRY_DELAY', 5))
+outbox_max_retry_delay = float(os.getenv('RSVPBOT_OUTBOX_MAX_RETRY_DELAY', 60 * 60))
+
+# Statements that run longer than this many milliseconds are cancelled by
+# Postgres. 0 turns the timeout off.
+db_statement_timeout = int(os.getenv('RSVPBOT_DB_STATEMENT_TIMEOUT', 30 * 1000))
+
+# Statements that take at least this many milliseconds are logged.
+db_slow_query_ms = float(os.getenv('RSVPBOT_DB_SLOW_QUERY_MS', 500))
+
+# Set to 'true' to log every statement, or 'debug' to log result rows too.
+db_echo = {'true': True, 'debug': 'debug'}.get(os.getenv('RSVPBOT_DB_ECHO', '').lower(), False)
+
+# The poller adds new events from RC with a few set-based statements. Set
+# RSVPBOT_BULK_INGEST=false to add them one ORM object at a time instead.
+bulk_ingest = os.getenv('RSVPBOT_BULK_INGEST', 'true').lower() not in ('', '0', 'false', 'no')
+
+# Events that ended more than this many days ago are moved from events to
+# events_archive by the poller, archive_batch_size at a time. 0 turns
+# archiving off.
+archive_after_days = float(os.getenv('RSVPBOT_ARCHIVE_AFTER_DAYS', 30))
+archive_batch_size = int(os.getenv('RSVPBOT_ARCHIVE_BATCH_SIZE', 1000))
+
+# The poller looks for new events every poll_new_events_interval seconds. The
+# interval doubles for every hour since the newest event was created, up to
+# poll_new_events_max_interval, which is also used during poll_quiet_hours
+# ('start-end' hours in poll_timezone, empty to turn off).
+poll_new_events_interval = float(os.getenv('RSVPBOT_POLL_NEW_EVENTS_INTERVAL', 15))
+poll_new_events_max_interval = float(os.getenv('RSVPBOT_POLL_NEW_EVENTS_MAX_INTERVAL', 5 * 60))
+poll_quiet_hours = os.getenv('RSVPBOT_POLL_QUIET_HOURS', '1-7')
+poll_timezone = os.getenv('RSVPBOT_POLL_TIMEZONE', 'America/New_York')
+
+# Upcoming events with a thread are refreshed from RC every
+# poll_tracked_events_interval seconds, and the ones starting within the hour
+# every poll_imminent_events_interval seconds. Archiving and other clean up
+# runs every poll_clean_up_interval seconds.
+poll_tracked_events_interval = float(os.getenv('RSVPBOT_POLL_TRACKED_EVENTS_INTERVAL', 60))
+poll_imminent_events_interval = float(os.getenv('RSVPBOT_POLL_IMMINENT_EVENTS_INTERVAL', 5))
+poll_clean_up_interval = float(os.getenv('RSVPBOT_POLL_CLEAN_UP_INTERVAL', 5 * 60))
+
+# Set RSVPBOT_WEBHOOK_PORT to have RC push event changes to /rc/webhook on
+# that port, signed with RSVPBOT_WEBHOOK_SECRET. With webhooks on, the poller
+# only checks RC every webhook_reconcile_interval seconds, for anything a
+# webhook missed.
+webhook_port = int(os.getenv('RSVPBOT_WEBHOOK_PORT', 0))
+webhook_secret = os.getenv('RSVPBOT_WEBHOOK_SECRET')
+webhook_reconcile_interval = float(os.getenv('RSVPBOT_WEBHOOK_RECONCILE_INTERVAL', 10 * 60))
+
+if webhook_port and not webhook_secret:
+    raise RuntimeError("RSVPBOT_WEBHOOK_PORT is set, so RSVPBOT_WEBHOOK_SECRET must be too.")
+
+# Every thread that uses the database holds at most one connection at a time:
+# the worker_pool_size command workers (or the asyncio runtime's command
+# executor), the Zulip listener, the outbox drainer, the poller and, with
+# webhooks on, the webhook receiver, which applies one webhook at a time. So
+# by default the pool has room for all of them at once:
+# worker_pool_size + 3, plus 1 with webhooks. Postgres notifications use
+# connections of their own, outside the pool. The pool can grow by
+# db_max_overflow more connections under load.
+db_pool_size = int(os.getenv('RSVPBOT_DB_POOL_SIZE', worker_pool_size + 3 + (1 if webhook_port else 0)))
+db_max_overflow = int(os.getenv('RSVPBOT_DB_MAX_OVERFLOW', 5))
+db_pool_timeout = float(os.getenv('RSVPBOT_DB_POOL_TIMEOUT', 30))
+db_pool_pre_ping = os.getenv('RSVPBOT_DB_PRE_PING', 'true').lower() not in ('', '0', 'false', 'no')
+
+# Each wait is randomly made up to poll_jitter (a fraction) longer or shorter.
+# A job that fails waits twice as long after each failure, up to
+# poll_max_backoff seconds.
+poll_jitter = float(os.getenv('RSVPBOT_POLL_JITTER', 0.1))
+poll_max_backoff = float(os.getenv('RSVPBOT_POLL_MAX_BACKOFF', 10 * 60))
@@ -0,0 +1,29 @@
+import models
+from cache import LRUCache
+
+class ProcessedMessages:
+    """Remembers which Zulip messages have been handled, so that events
+    redelivered after a reconnect don't RSVP people or reply twice.
+
+    Recently seen message ids are kept in memory. With persist=True they're
+    also recorded in the processed_messages table, which survives restarts
+    and is shared by every bot process using the same database.
+    """
+    def __init__(self, maxsize, ttl, persist=False):
+        self.recent = LRUCache(maxsize, ttl)
+        self.persist = persist
+
+    def first_time(self, message_id):
+        """Returns True the first time it's called with message_id, and False after that."""
+        if message_id is None:
+            return True
+
+        if message_id in self.recent:
+            return False
+
+        self.recent.set(message_id, True)
+
+        if self.persist:
+            return models.claim_message(message_id)
+
+        return True
@@ -4,12 +4,15 @@ import re
 import random
 import os
 from copy import deepcopy
+import hashlib
+import hmac
 import json
 
 from flask import Flask, render_template, url_for, request, redirect
 from flask.json import jsonify
 import pytz
 import dateutil.parser
+import requests
 
 app = Flask(__name__)
 
@@ -166,6 +169,29 @@ original_api_data = [
 
 api_data = deepcopy(original_api_data)
 
+# Where to send webhooks when events change, like recurse.com does. Set with
+# WEBHOOK_URL and WEBHOOK_SECRET, or by POSTing url and secret to /webhooks.
+default_webhook = {'url': os.getenv('WEBHOOK_URL'), 'secret': os.getenv('WEBHOOK_SECRET', '')}
+webhook = dict(default_webhook)
+
+def fire_webhook(action, event):
+    if not webhook['url']:
+        return
+
+    body = json.dumps({
+        'action': action,
+        'event': {k: v for k, v in event.items() if k != 'participants'},
+    }).encode()
+    signature = 'sha256=' + hmac.new(webhook['secret'].encode(), body, hashlib.sha256).hexdigest()
+
+    try:
+        requests.post(webhook['url'], data=body, timeout=5, headers={
+            'Content-Type': 'application/json',
+            'X-RC-Signature': signature,
+        })
+    except requests.RequestException as e:
+        print("Couldn't send the {} webhook for event {}: {}".format(action, event['id'], e))
+
 @app.template_filter('dtformat')
 def dtformat(value, format='%-m-%d-%Y at %H:%M'):
     return dateutil.parser.parse(value).strftime(format)
@@ -180,9 +206,10 @@ def index():
 
 @app.route('/reset', methods=['POST'])
 def reset():
-    global next_event_id, api_data
-    next_event_id = 1
+    global next_event_id, api_data, webhook
+    next_event_id = len(original_api_data) + 1
     api_data = deepcopy(original_api_data)
+    webhook = dict(default_webhook)
 
     return redirect(url_for('index'))
 
@@ -203,9 +230,17 @@ def create():
     )
 
     api_data.append(event)
+    fire_webhook('created', event)
 
     return redirect(url_for('index'))
 
+@app.route('/webhooks', methods=['POST'])
+def set_webhook():
+    webhook['url'] = request.values.get('url') or None
+    webhook['secret'] = request.values.get('secret', '')
+
+    return jsonify(webhook)
+
 
 # parses a date and sets tzinfo to UTC if it is not set.
 # otherwise we'll fail later
@@ -220,6 +255,9 @@ def parse_date(s):
 def created_on_or_after(event, date):
     return dateutil.parser.parse(event['created_at']) >= date
 
+def starts_on_or_after(event, date):
+    return dateutil.parser.parse(event['start_time']) >= date
+
 def find_event(id):
     return next((e for e in api_data if e['id'] == id), None)
 
@@ -236,18 +274,44 @@ def render_event(event):
 def render_events(events):
     return jsonify([filter_participants(event) for event in events])
 
+# Answers If-None-Match with a 304 when the events haven't changed.
+def render_events_conditionally(events):
+    response = render_events(events)
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route('/api/v1/events')
 def events():
-    if 'created_at_or_after' in request.values:
-        date = parse_date(request.values['created_at_or_after'])
-        events = [event for event in api_data if created_on_or_after(event, date)]
-        return render_events(sort_by_start_time(events))
+    if 'created_at_or_after' in request.values or 'starts_at_or_after' in request.values:
+        events = api_data
+
+        if 'created_at_or_after' in request.values:
+            date = parse_date(request.values['created_at_or_after'])
+            events = [event for event in events if created_on_or_after(event, date)]
+
+        if 'starts_at_or_after' in request.values:
+            date = parse_date(request.values['starts_at_or_after'])
+            events = [event for event in events if starts_on_or_after(event, date)]
+
+        return render_events_conditionally(sort_by_start_time(events))
     elif 'ids' in request.values:
         ids = json.loads(request.values['ids'])
-        return render_events(e for e in map(find_event, ids) if e)
+
+        if len(ids) > MAX_IDS_PER_REQUEST:
+            return too_many_ids()
+
+        return render_events_conditionally([e for e in map(find_event, ids) if e])
     else:
         return render_events([])
 
+# Like recurse.com, refuse to look up more than this many events at once.
+MAX_IDS_PER_REQUEST = 100
+
+def too_many_ids():
+    response = jsonify({"message": "too_many_ids", "max_ids": MAX_IDS_PER_REQUEST})
+    response.status_code = 400
+    return response
+
 def not_found():
     response = jsonify({"message":"not_found"})
     response.status_code = 404
@@ -291,6 +355,8 @@ def update_event(id):
     for k, v in updates.items():
         event[k] = v
 
+    fire_webhook('updated', event)
+
     return render_event(event)
 
 # If user_param and user_param_value are set correctly
@@ -341,6 +407,7 @@ def join(id):
         return user_not_specified()
 
     join_event(user, event)
+    fire_webhook('joined', event)
 
     return jsonify({
         'joined': True,
@@ -361,6 +428,7 @@ def leave(id):
         return user_not_specified()
 
     leave_event(user, event)
+    fire_webhook('left', event)
 
     return jsonify({})
 
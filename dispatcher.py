@@ -0,0 +1,55 @@
+import queue
+import threading
+import traceback
+
+_STOP = object()
+
+class Dispatcher:
+    """Runs a handler over submitted items on a fixed pool of worker threads.
+
+    Every item is submitted with a key. Items with the same key always go to
+    the same worker, so they are handled one at a time in the order they were
+    submitted. Items with different keys can be handled in parallel.
+
+    Each worker has its own bounded queue. When a worker's queue is full,
+    submit() blocks until there's room, which keeps memory use capped during
+    bursts.
+    """
+    def __init__(self, handler, workers=4, queue_depth=100):
+        if workers < 1:
+            raise ValueError("a dispatcher needs at least one worker")
+
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=queue_depth) for _ in range(workers)]
+        self.threads = []
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(q,), name="dispatcher-{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Finishes everything already submitted, then stops the workers."""
+        for q in self.queues:
+            q.put(_STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def submit(self, key, item):
+        self.queues[hash(key) % len(self.queues)].put(item)
+
+    def work(self, q):
+        while True:
+            item = q.get()
+
+            if item is _STOP:
+                return
+
+            try:
+                self.handler(item)
+            except Exception:
+                print(traceback.format_exc())
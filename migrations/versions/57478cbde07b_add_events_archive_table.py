@@ -0,0 +1,44 @@
+"""add events_archive table
+
+Revision ID: 57478cbde07b
+Revises: 7cb8d3bf3e8f
+Create Date: 2026-10-18 06:13:23.270856
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '57478cbde07b'
+down_revision = '7cb8d3bf3e8f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('events_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('recurse_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('created_by', sa.String(), nullable=True),
+    sa.Column('url', sa.String(), nullable=True),
+    sa.Column('timezone', sa.String(), nullable=True),
+    sa.Column('start_time', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('end_time', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('title', sa.String(), nullable=True),
+    sa.Column('stream', sa.String(), nullable=True),
+    sa.Column('subject', sa.String(), nullable=True),
+    sa.Column('archived_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_events_archive_recurse_id', 'events_archive', ['recurse_id'])
+    op.create_index('ix_events_archive_stream_subject', 'events_archive', ['stream', 'subject'])
+    op.create_index('ix_events_end_time', 'events', ['end_time'])
+
+
+def downgrade():
+    op.drop_index('ix_events_end_time', table_name='events')
+    op.drop_index('ix_events_archive_stream_subject', table_name='events_archive')
+    op.drop_index('ix_events_archive_recurse_id', table_name='events_archive')
+    op.drop_table('events_archive')
@@ -0,0 +1,26 @@
+"""add rc_fingerprint to events
+
+Revision ID: 689a0eb38d4a
+Revises: d3bf959b7ed7
+Create Date: 2026-10-18 06:23:15.478911
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '689a0eb38d4a'
+down_revision = 'd3bf959b7ed7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('events', sa.Column('rc_fingerprint', sa.String(), nullable=True))
+    op.add_column('events_archive', sa.Column('rc_fingerprint', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('events_archive', 'rc_fingerprint')
+    op.drop_column('events', 'rc_fingerprint')
@@ -0,0 +1,36 @@
+"""add outbox table
+
+Revision ID: 7cb8d3bf3e8f
+Revises: fee3cf2680ca
+Create Date: 2026-10-18 06:04:28.312859
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7cb8d3bf3e8f'
+down_revision = 'fee3cf2680ca'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbox_next_attempt_at', 'outbox', ['next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_outbox_next_attempt_at', table_name='outbox')
+    op.drop_table('outbox')
@@ -0,0 +1,29 @@
+"""add sync_state table
+
+Revision ID: d3bf959b7ed7
+Revises: 57478cbde07b
+Create Date: 2026-10-18 06:17:46.826301
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3bf959b7ed7'
+down_revision = '57478cbde07b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sync_state',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('cursor', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('sync_state')
@@ -0,0 +1,30 @@
+"""add zulip_queues table
+
+Revision ID: e7bd08c0d5a2
+Revises: 94c575f6e10f
+Create Date: 2026-10-18 05:53:07.117628
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7bd08c0d5a2'
+down_revision = '94c575f6e10f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('zulip_queues',
+    sa.Column('bot_email', sa.String(), nullable=False),
+    sa.Column('queue_id', sa.String(), nullable=False),
+    sa.Column('last_event_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('bot_email')
+    )
+
+
+def downgrade():
+    op.drop_table('zulip_queues')
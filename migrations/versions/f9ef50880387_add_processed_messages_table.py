@@ -0,0 +1,30 @@
+"""add processed_messages table
+
+Revision ID: f9ef50880387
+Revises: e7bd08c0d5a2
+Create Date: 2026-10-18 05:57:38.287280
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f9ef50880387'
+down_revision = 'e7bd08c0d5a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('processed_messages',
+    sa.Column('message_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('processed_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('message_id')
+    )
+    op.create_index('ix_processed_messages_processed_at', 'processed_messages', ['processed_at'])
+
+
+def downgrade():
+    op.drop_index('ix_processed_messages_processed_at', table_name='processed_messages')
+    op.drop_table('processed_messages')
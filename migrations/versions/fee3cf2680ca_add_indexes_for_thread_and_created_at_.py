@@ -0,0 +1,52 @@
+"""add indexes for thread and created_at lookups
+
+Revision ID: fee3cf2680ca
+Revises: f9ef50880387
+Create Date: 2026-10-18 05:58:29.308285
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fee3cf2680ca'
+down_revision = 'f9ef50880387'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nothing stopped two events from sharing a thread before now. Keep the
+    # most recently created event in each thread and detach the others.
+    conn = op.get_bind()
+    ranked = '''
+        SELECT id, stream, subject,
+               row_number() OVER (PARTITION BY stream, subject ORDER BY created_at DESC, id DESC) AS n
+        FROM events
+        WHERE stream IS NOT NULL AND subject IS NOT NULL
+    '''
+    detached = conn.execute(sa.text('SELECT id, stream, subject FROM ({}) AS ranked WHERE n > 1 ORDER BY id'.format(ranked))).fetchall()
+
+    for id, stream, subject in detached:
+        print("Removing event {} from #{} > {}, which already has a newer event".format(id, stream, subject))
+
+    if detached:
+        conn.execute(sa.text('UPDATE events SET stream = NULL, subject = NULL WHERE id IN :ids').bindparams(
+            sa.bindparam('ids', expanding=True)), {'ids': [row.id for row in detached]})
+
+    # Only one event per thread. Unset threads (NULL) don't conflict.
+    op.create_index('ix_events_stream_subject', 'events', ['stream', 'subject'], unique=True)
+
+    # The poller looks for the most recently created event on every cycle.
+    op.create_index('ix_events_created_at', 'events', ['created_at'])
+
+    # The poller refreshes upcoming events that are tracked in a thread.
+    op.create_index('ix_events_tracked_start_time', 'events', ['start_time'],
+                    postgresql_where=sa.text('stream IS NOT NULL AND subject IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_events_tracked_start_time', table_name='events')
+    op.drop_index('ix_events_created_at', table_name='events')
+    op.drop_index('ix_events_stream_subject', table_name='events')
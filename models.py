@@ -1,31 +1,129 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import hashlib
+import json
 import secrets
 from os import environ
 import re
+import threading
+import time
 
 import dateutil.parser
 import pytz
 import sqlalchemy
 
-from sqlalchemy import create_engine, Column, Integer, String, TIMESTAMP
+from sqlalchemy import create_engine, tuple_, BigInteger, Column, Index, Integer, String, TIMESTAMP
+from sqlalchemy.dialects.postgresql import insert, JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session, validates
+from sqlalchemy.orm import sessionmaker, scoped_session, validates, object_session, column_property
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.inspection import inspect
 
+import config
+import notify
 import zulip_util
 import rc
 import strings
+import tracing
+from cache import LRUCache
 
 def database_url():
     return re.sub(r'^postgres://', 'postgresql://', environ['DATABASE_URL'])
 
-engine = create_engine(database_url(), echo=True)
+def make_engine():
+    connect_args = {}
+
+    if config.db_statement_timeout:
+        connect_args['options'] = '-c statement_timeout={:d}'.format(config.db_statement_timeout)
+
+    return create_engine(
+        database_url(),
+        echo=config.db_echo,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout,
+        pool_pre_ping=config.db_pool_pre_ping,
+        connect_args=connect_args
+    )
+
+def time_statements(engine):
+    """Times every statement, logging slow ones and recording them in the current trace."""
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - conn.info['statement_started'].pop()) * 1000
+
+        if duration_ms >= config.db_slow_query_ms:
+            print("Slow query ({:.1f} ms): {}".format(duration_ms, statement))
+
+        tracing.record('db', statement.split(None, 1)[0].upper(), duration_ms, sql=statement[:200])
+
+    @sqlalchemy.event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # after_cursor_execute doesn't run for statements that fail.
+        started = context.connection.info.get('statement_started') if context.connection is not None else None
+
+        if started:
+            started.pop()
+
+engine = make_engine()
+time_statements(engine)
 Base = declarative_base()
 
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
+class IdentityMapSizes:
+    """The largest identity map each kind of session_scope has ended with.
+
+    A new largest size is logged, so a long-running process that keeps
+    logging these is holding on to more and more objects.
+    """
+    def __init__(self):
+        self.largest = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, size):
+        with self.lock:
+            if size <= self.largest.get(name, 0):
+                return
+
+            self.largest[name] = size
+
+        print("Largest identity map for a {} so far: {} objects".format(name, size))
+
+identity_map_sizes = IdentityMapSizes()
+
+@contextmanager
+def session_scope(name):
+    """One unit of work, like handling a message or a poll cycle, on this thread's Session.
+
+    Afterwards, anything left uncommitted is rolled back and the session is
+    closed and thrown away, so the objects it loaded don't pile up over weeks
+    of uptime. The size of its identity map is added to the current trace.
+    """
+    try:
+        yield
+    finally:
+        if Session.registry.has():
+            size = len(Session().identity_map)
+            tracing.annotate(identity_map_size=size)
+            identity_map_sizes.record(name, size)
+
+        Session.remove()
+
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (
+        Index('ix_events_stream_subject', 'stream', 'subject', unique=True),
+        Index('ix_events_created_at', 'created_at'),
+        Index('ix_events_end_time', 'end_time'),
+        Index('ix_events_tracked_start_time', 'start_time',
+              postgresql_where=sqlalchemy.text('stream IS NOT NULL AND subject IS NOT NULL')),
+    )
 
     id = Column(Integer, primary_key=True)
     recurse_id = Column(Integer, unique=True)
@@ -36,8 +134,12 @@ class Event(Base):
     _start_time = Column("start_time", TIMESTAMP(timezone=True))
     _end_time = Column("end_time", TIMESTAMP(timezone=True))
     title = Column(String)
-    stream = Column(String)
-    subject = Column(String)
+    # active_history loads the old thread when these are set, so the thread
+    # cache can forget it even if the event had been expired.
+    stream = column_property(Column(String), active_history=True)
+    subject = column_property(Column(String), active_history=True)
+    # rc_fingerprint of the RC data last applied, so unchanged data can be skipped.
+    rc_fingerprint = Column(String)
 
     @validates('subject')
     def validate_stream_and_subject(self, key, field):
@@ -55,9 +157,21 @@ class Event(Base):
     def created_at(self, value):
         self._created_at = value
 
+    def rendered(self, key, render):
+        """Returns render(), remembered until the event's times or thread change."""
+        cache = self.__dict__.setdefault('_render_cache', {})
+
+        if key not in cache:
+            cache[key] = render()
+
+        return cache[key]
+
+    def forget_rendered(self):
+        self.__dict__.pop('_render_cache', None)
+
     @property
     def start_time(self):
-        return self._start_time.astimezone(pytz.timezone(self.timezone))
+        return self.rendered('start_time', lambda: self._start_time.astimezone(pytz.timezone(self.timezone)))
 
     @start_time.setter
     def start_time(self, value):
@@ -65,7 +179,7 @@ class Event(Base):
 
     @property
     def end_time(self):
-        return self._end_time.astimezone(pytz.timezone(self.timezone))
+        return self.rendered('end_time', lambda: self._end_time.astimezone(pytz.timezone(self.timezone)))
 
     @end_time.setter
     def end_time(self, value):
@@ -78,7 +192,7 @@ class Event(Base):
 
     def refresh_from_api(self, include_participants=False):
         data = rc.get_event(self.recurse_id, include_participants=include_participants)
-        event_data = event_dict(data)
+        event_data = api_attributes(data)
         self.update(**event_data)
         return data
 
@@ -87,6 +201,9 @@ class Event(Base):
 
     # 5–7pm EDT, Wednesday, May 17, 2017
     def timestamp(self):
+        return self.rendered('timestamp', self.render_timestamp)
+
+    def render_timestamp(self):
         start = self.start_time.strftime("%-I:%M%p").lower()
         end = self.end_time.strftime("%-I:%M%p").lower()
         zone = self.start_time.tzinfo.tzname(self.start_time)
@@ -95,76 +212,535 @@ class Event(Base):
         return "{}–{} {}, {}".format(start, end, zone, date)
 
     def zulip_link(self):
+        return self.rendered('zulip_link', self.render_zulip_link)
+
+    def render_zulip_link(self):
         # This format doesn't autolink yet. Should create an issue for it.
         # return "#**{} > {}**".format(self.stream, self.subject)
 
         url = zulip_util.stream_topic_to_narrow_url(self.stream, self.subject)
         return "**[#{} > {}]({})**".format(self.stream, self.subject, url)
 
-@sqlalchemy.event.listens_for(Event, 'before_insert')
-def ensure_one_event_per_thread(mapper, conn, event):
-    if event.already_initialized() and event_exists(event.stream, event.subject):
-        zulip_util.send_message({
+# start_time, end_time, timestamp() and zulip_link() are rendered from these
+# columns, so setting any of them, or reloading the event, throws the rendered
+# values away.
+@sqlalchemy.event.listens_for(Event._start_time, 'set')
+@sqlalchemy.event.listens_for(Event._end_time, 'set')
+@sqlalchemy.event.listens_for(Event.timezone, 'set')
+@sqlalchemy.event.listens_for(Event.stream, 'set')
+@sqlalchemy.event.listens_for(Event.subject, 'set')
+def forget_rendered_on_set(event, value, oldvalue, initiator):
+    event.forget_rendered()
+
+@sqlalchemy.event.listens_for(Event, 'load')
+@sqlalchemy.event.listens_for(Event, 'refresh')
+@sqlalchemy.event.listens_for(Event, 'expire')
+def forget_rendered_on_load(event, *args):
+    event.forget_rendered()
+
+class ArchivedEvent(Base):
+    """An event that ended long enough ago to be moved out of events by archive_events.
+
+    Only kept so commands in its old thread get a better answer than "this
+    isn't an event", so it has the same columns as events but none of its
+    behavior. id is the event's id from the events table.
+    """
+    __tablename__ = 'events_archive'
+    __table_args__ = (
+        Index('ix_events_archive_stream_subject', 'stream', 'subject'),
+        Index('ix_events_archive_recurse_id', 'recurse_id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    recurse_id = Column(Integer)
+    created_at = Column(TIMESTAMP(timezone=True))
+    created_by = Column(String)
+    url = Column(String)
+    timezone = Column(String)
+    start_time = Column(TIMESTAMP(timezone=True))
+    end_time = Column(TIMESTAMP(timezone=True))
+    title = Column(String)
+    stream = Column(String)
+    subject = Column(String)
+    rc_fingerprint = Column(String)
+    archived_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+class ZulipQueue(Base):
+    """The Zulip event queue a bot was last reading from, so that it can
+    resume the queue after a restart instead of registering a new one."""
+    __tablename__ = 'zulip_queues'
+
+    bot_email = Column(String, primary_key=True)
+    queue_id = Column(String, nullable=False)
+    last_event_id = Column(Integer, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+class ProcessedMessage(Base):
+    """A Zulip message the bot has already handled, so it isn't handled twice."""
+    __tablename__ = 'processed_messages'
+    __table_args__ = (Index('ix_processed_messages_processed_at', 'processed_at'),)
+
+    message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+class SyncState(Base):
+    """How far the poller has read a feed from RC, so that each poll only
+    asks for what's new since the last one."""
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)
+    cursor = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+class OutboxMessage(Base):
+    """A Zulip message or RC update waiting to be sent by outbox.py.
+
+    Listeners write these in the same transaction as the change that caused
+    them, so nothing is sent for changes that are rolled back, and commits
+    never wait on the network. next_attempt_at is NULL once we've given up.
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (Index('ix_outbox_next_attempt_at', 'next_attempt_at'),)
+
+    id = Column(BigInteger, primary_key=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    attempts = Column(Integer, nullable=False)
+    next_attempt_at = Column(TIMESTAMP(timezone=True))
+    last_error = Column(String)
+
+    ZULIP = 'zulip'
+    RC_UPDATE = 'rc_update'
+
+    def ordering_key(self):
+        """Messages with the same key are sent in the order they were written."""
+        if self.kind == self.ZULIP:
+            return (self.kind, self.payload['to'], self.payload.get('subject'))
+        else:
+            return (self.kind, self.payload['event_id'])
+
+# Set when a transaction that wrote to the outbox commits, so the drainer
+# doesn't have to wait for its next poll.
+outbox_ready = threading.Event()
+
+def enqueue_many(conn, messages):
+    """Queues (kind, payload) pairs with a single INSERT."""
+    if messages:
+        conn.execute(OutboxMessage.__table__.insert().values([
+            {
+                'kind': kind,
+                'payload': payload,
+                'created_at': sqlalchemy.func.now(),
+                'attempts': 0,
+                'next_attempt_at': sqlalchemy.func.now()
+            }
+            for kind, payload in messages
+        ]))
+
+def enqueue(conn, kind, payload):
+    enqueue_many(conn, [(kind, payload)])
+
+def zulip_message(msg):
+    """An outbox message for a reply shaped like RSVP.process_message's."""
+    return (OutboxMessage.ZULIP, zulip_util.outgoing_message(msg))
+
+def rc_update(recurse_id, updates):
+    return (OutboxMessage.RC_UPDATE, {'event_id': recurse_id, 'updates': updates})
+
+def enqueue_zulip_message(conn, msg):
+    enqueue(conn, *zulip_message(msg))
+
+def enqueue_rc_update(conn, recurse_id, updates):
+    enqueue(conn, *rc_update(recurse_id, updates))
+
+def thread_conflict_messages(event):
+    """Tells a thread, and RC, that an event from RC can't use a thread that already has one."""
+    return [
+        zulip_message({
             "type": "stream",
             "display_recipient": event.stream,
             "subject": event.subject,
             "body": strings.ERROR_THREAD_FROM_RC_ALREADY_AN_EVENT.format(title=event.title, url=event.url)
-        })
-        rc.update_event(event.recurse_id, {
+        }),
+        rc_update(event.recurse_id, {
             'stream': None,
             'subject': None
-        })
-        raise ValueError('cannot add event to a thread already tracking another event')
+        }),
+    ]
 
-@sqlalchemy.event.listens_for(Event, 'after_insert')
-def announce_on_zulip(mapper, conn, event):
+def init_messages(event):
+    """What to send when an event is added: a welcome in its thread, or an announcement."""
     if event.already_initialized():
-        zulip_util.send_message({
+        return [zulip_message({
             "type": "stream",
             "display_recipient": event.stream,
             "subject": event.subject,
             "body": strings.MSG_INIT_SUCCESSFUL.format(event.title, event.url)
-        })
+        })]
+    else:
+        return [(OutboxMessage.ZULIP, zulip_util.announce_message(event))]
+
+def mark_outbox_written(event):
+    session = object_session(event)
+    if session is not None:
+        session.info['outbox_written'] = True
+
+@sqlalchemy.event.listens_for(session_factory, 'after_commit')
+def wake_outbox(session):
+    if session.info.pop('outbox_written', False):
+        outbox_ready.set()
+
+@sqlalchemy.event.listens_for(session_factory, 'after_rollback')
+def forget_outbox_writes(session):
+    session.info.pop('outbox_written', None)
+
+@sqlalchemy.event.listens_for(Event, 'before_insert')
+def ensure_one_event_per_thread(mapper, conn, event):
+    if event.already_initialized() and event_exists(event.stream, event.subject):
+        # The insert is about to be rolled back, taking anything written on
+        # conn with it, so the messages are queued once the transaction is over.
+        object_session(event).info.setdefault('thread_conflicts', []).extend(thread_conflict_messages(event))
+        raise ValueError('cannot add event to a thread already tracking another event')
+
+@sqlalchemy.event.listens_for(session_factory, 'after_transaction_end')
+def queue_thread_conflicts(session, transaction):
+    # Only once the session has given its connection back, so this never
+    # needs a second one.
+    if transaction.parent is None and 'thread_conflicts' in session.info:
+        with engine.begin() as conn:
+            enqueue_many(conn, session.info.pop('thread_conflicts'))
+
+        outbox_ready.set()
+
+@sqlalchemy.event.listens_for(Event, 'after_insert')
+def announce_on_zulip(mapper, conn, event):
+    enqueue_many(conn, init_messages(event))
+    mark_outbox_written(event)
+
+TitleChanged = namedtuple('TitleChanged', ['old', 'new'])
+TimeChanged = namedtuple('TimeChanged', ['old_start', 'old_end', 'new_start', 'new_end'])
+ThreadMoved = namedtuple('ThreadMoved', ['old_thread', 'new_thread'])
+
+class ChangeSet:
+    """What a flush changed about one event, as TitleChanged, TimeChanged and ThreadMoved.
+
+    Built once per updated event by publish_changes, which hands it to every
+    subscriber registered with on_change.
+    """
+    def __init__(self, changes):
+        self.changes = {type(change): change for change in changes}
+
+    @classmethod
+    def of(cls, event):
+        state = inspect(event)
+        changes = []
+
+        title = state.attrs.title.history
+        if title.has_changes():
+            changes.append(TitleChanged(old_value(title), event.title))
+
+        start, end = state.attrs._start_time.history, state.attrs._end_time.history
+        if start.has_changes() or end.has_changes():
+            changes.append(TimeChanged(old_value(start), old_value(end), event._start_time, event._end_time))
+
+        stream, subject = state.attrs.stream.history, state.attrs.subject.history
+        if stream.has_changes() or subject.has_changes():
+            changes.append(ThreadMoved((old_value(stream), old_value(subject)), (event.stream, event.subject)))
+
+        return cls(changes)
+
+    def __contains__(self, change_type):
+        return change_type in self.changes
+
+    def __getitem__(self, change_type):
+        return self.changes[change_type]
+
+    def __bool__(self):
+        return bool(self.changes)
+
+def old_value(history):
+    """An attribute's value before the flush, or None if it wasn't loaded."""
+    if history.deleted:
+        return history.deleted[0]
+    elif history.unchanged:
+        return history.unchanged[0]
     else:
-        zulip_util.announce_event(event)
+        return None
+
+change_subscribers = []
+
+def on_change(*change_types):
+    """Registers f(conn, event, changes) to run after a flush that makes any of change_types."""
+    def register(f):
+        change_subscribers.append((change_types, f))
+        return f
+
+    return register
 
 @sqlalchemy.event.listens_for(Event, 'after_update')
-def post_changes_to_zulip(mapper, conn, event):
+def publish_changes(mapper, conn, event):
+    changes = ChangeSet.of(event)
+
+    if changes:
+        for change_types, subscriber in change_subscribers:
+            if any(change_type in changes for change_type in change_types):
+                subscriber(conn, event, changes)
+
+@on_change(TitleChanged, TimeChanged)
+def post_changes_to_zulip(conn, event, changes):
     messages = []
 
     if event.already_initialized():
-        changes = get_changes(event)
-
-        if 'title' in changes:
+        if TitleChanged in changes:
             messages.append("The title has changed: " + event.title)
 
-        if '_start_time' in changes or '_end_time' in changes:
+        if TimeChanged in changes:
             messages.append("The time has changed: " + event.timestamp())
 
     if messages:
-        zulip_util.send_message({
+        enqueue_zulip_message(conn, {
             "type": "stream",
             "display_recipient": event.stream,
             "subject": event.subject,
             "body": "**This event has changed!**\n" + "\n".join(messages)
         })
+        mark_outbox_written(event)
 
-@sqlalchemy.event.listens_for(Event, 'after_update')
-def notify_rc_of_thread_changes(mapper, conn, event):
+@on_change(ThreadMoved)
+def notify_rc_of_thread_changes(conn, event, changes):
     if event.already_initialized():
-        changes = get_changes(event)
+        enqueue_rc_update(conn, event.recurse_id, {
+            'stream': event.stream,
+            'subject': event.subject
+        })
+        mark_outbox_written(event)
+
+@on_change(ThreadMoved)
+def forget_rc_fingerprint(conn, event, changes):
+    """Makes the next data from RC apply in full after we move an event's thread.
+
+    The fingerprint describes RC's thread, not ours, so if the outbox gives up
+    on telling RC about the move, RC's thread must not be skipped as unchanged.
+    Moves that came from RC set a new fingerprint in the same flush.
+    """
+    if not inspect(event).attrs.rc_fingerprint.history.has_changes():
+        conn.execute(Event.__table__.update().where(Event.__table__.c.id == event.id).values(rc_fingerprint=None))
+        set_committed_value(event, 'rc_fingerprint', None)
+
+class ThreadCache:
+    """Remembers which event, if any, is tracked in each (stream, subject) thread.
+
+    Values are (event id, recurse_id) for threads that are events, and None for
+    threads that aren't, so repeated commands in either kind of thread don't
+    need to query the database. Entries are dropped by the listeners below
+    whenever an event's thread changes, and again once that change is committed,
+    since other threads can't see it before then.
+    """
+    _MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.entries = LRUCache(maxsize, ttl)
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def find(self, stream, subject):
+        key = (stream, subject)
+        found = self.entries.get(key, self._MISSING)
+
+        if found is self._MISSING:
+            generation = self.generation
+            row = Session.query(Event.id, Event.recurse_id).filter(Event.stream == stream).filter(Event.subject == subject).first()
+            found = tuple(row) if row else None
+
+            # Don't cache the result if any thread changed while we were looking.
+            with self.lock:
+                if generation == self.generation:
+                    self.entries.set(key, found)
+
+        return found
+
+    def invalidate(self, stream, subject):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop((stream, subject))
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+thread_cache = ThreadCache(config.thread_cache_size, config.thread_cache_ttl)
+
+def find_thread(stream, subject):
+    """Returns (event id, recurse_id) for the event tracked in a thread, or None."""
+    if stream and subject:
+        return thread_cache.find(stream, subject)
+    else:
+        return None
+
+def thread_keys(event):
+    """The threads an event is in now, and was in before any unflushed changes."""
+    state = inspect(event)
+    old_stream = state.attrs.stream.history.deleted
+    old_subject = state.attrs.subject.history.deleted
+
+    return {
+        (event.stream, event.subject),
+        (old_stream[0] if old_stream else event.stream, old_subject[0] if old_subject else event.subject),
+    }
+
+def forget_threads(session, keys):
+    for stream, subject in keys:
+        thread_cache.invalidate(stream, subject)
+
+    if session is not None:
+        session.info.setdefault('changed_threads', set()).update(keys)
+
+        # Other processes forget them once the change commits.
+        threads = {(stream, subject) for stream, subject in keys if stream and subject}
+        if threads:
+            notify.send(session.connection(), notify.INVALIDATE, notify.threads_payload(threads))
+
+def forget_all_threads():
+    thread_cache.clear()
+    archived_threads.clear()
+
+def forget_notified_threads(payload):
+    """Handles notify.INVALIDATE from another process."""
+    if payload == '*':
+        forget_all_threads()
+        return
 
-        if 'stream' in changes or 'subject' in changes:
-            rc.update_event(event.recurse_id, {
-                'stream': event.stream,
-                'subject': event.subject
-            })
+    for stream, subject in json.loads(payload):
+        thread_cache.invalidate(stream, subject)
+        archived_threads.pop((stream, subject))
+
+def listen_for_thread_changes(running):
+    """Keeps this process's thread caches in step with changes made by other processes."""
+    notify.listen(running, engine, {notify.INVALIDATE: forget_notified_threads}, on_connect=forget_all_threads)
+
+@sqlalchemy.event.listens_for(Event, 'after_insert')
+@sqlalchemy.event.listens_for(Event, 'after_delete')
+def invalidate_thread_cache(mapper, conn, event):
+    forget_threads(object_session(event), thread_keys(event))
+
+@on_change(ThreadMoved)
+def invalidate_moved_thread_cache(conn, event, changes):
+    moved = changes[ThreadMoved]
+    forget_threads(object_session(event), {moved.old_thread, moved.new_thread})
+
+@sqlalchemy.event.listens_for(session_factory, 'after_commit')
+def invalidate_committed_threads(session):
+    for stream, subject in session.info.pop('changed_threads', ()):
+        thread_cache.invalidate(stream, subject)
+
+@sqlalchemy.event.listens_for(session_factory, 'after_rollback')
+def forget_rolled_back_threads(session):
+    for stream, subject in session.info.pop('changed_threads', ()):
+        thread_cache.invalidate(stream, subject)
+
+# (stream, subject) -> (title, url) of the last event archived from that thread, or None.
+archived_threads = LRUCache(config.thread_cache_size, config.thread_cache_ttl)
+
+def find_archived_thread(stream, subject):
+    """Returns (title, url) for the most recent archived event in a thread, or None."""
+    if not (stream and subject):
+        return None
+
+    key = (stream, subject)
+    found = archived_threads.get(key, ThreadCache._MISSING)
+
+    if found is ThreadCache._MISSING:
+        row = (
+            Session.query(ArchivedEvent.title, ArchivedEvent.url)
+            .filter(ArchivedEvent.stream == stream)
+            .filter(ArchivedEvent.subject == subject)
+            .order_by(ArchivedEvent.end_time.desc())
+            .first()
+        )
+        found = tuple(row) if row else None
+        archived_threads.set(key, found)
+
+    return found
+
+def archive_events(ended_before, limit=None):
+    """Moves up to limit events that ended before ended_before into events_archive.
+
+    Done in one statement (a DELETE ... RETURNING feeding an INSERT), so an
+    event is never in both tables or neither. Returns how many were moved.
+    """
+    events = Event.__table__
+    archive = ArchivedEvent.__table__
+    columns = [column.name for column in events.c]
+
+    oldest = (
+        sqlalchemy.select(events.c.id)
+        .where(events.c.end_time < ended_before)
+        .order_by(events.c.end_time)
+        .limit(limit or config.archive_batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    moved = events.delete().where(events.c.id.in_(oldest)).returning(*events.c).cte('moved')
+
+    archived = Session.execute(
+        insert(archive)
+        .from_select(columns + ['archived_at'], sqlalchemy.select(*[moved.c[name] for name in columns], sqlalchemy.func.now()))
+        .returning(archive.c.stream, archive.c.subject)
+    ).all()
+
+    threads = {(stream, subject) for stream, subject in archived if stream and subject}
+    forget_threads(Session(), threads)
+
+    for thread in threads:
+        archived_threads.pop(thread)
+
+    Session.commit()
+    return len(archived)
+
+def refresh_event(thread, include_participants=False):
+    """Refreshes the event a thread points to from RC.
+
+    thread is what find_thread returned. The RC request happens first, so the
+    database is only touched once we have something to write. Returns the event
+    and the RC response, or (None, None) if the event is gone.
+    """
+    event_id, recurse_id = thread
+    data = rc.get_event(recurse_id, include_participants=include_participants)
+    event = Session.get(Event, event_id)
+
+    if event is None:
+        return None, None
+
+    event.update(**api_attributes(data))
+    return event, data
 
 def assign_attributes(model, attributes):
     for k, v in attributes.items():
         setattr(model, k, v)
     return model
 
+def rc_fingerprint(e):
+    """A hash of the parts of an RC event that event_dict reads.
+
+    Computed from the raw strings, so it's cheap enough to check for every
+    event RC sends before deciding whether to parse and apply it.
+    """
+    canonical = [
+        e['id'],
+        e['created_at'],
+        e['timezone'],
+        e['start_time'],
+        e['end_time'],
+        e['created_by']['name'],
+        e['url'],
+        e['title'],
+        e.get('stream'),
+        e.get('subject'),
+    ]
+
+    return hashlib.sha256(json.dumps(canonical, separators=(',', ':')).encode()).hexdigest()
+
 def event_dict(e):
     return {
         "recurse_id": e['id'],
@@ -176,9 +752,46 @@ def event_dict(e):
         "url": e['url'],
         "title": e['title'],
         "stream": e.get('stream'),
-        "subject": e.get('subject')
+        "subject": e.get('subject'),
+        "rc_fingerprint": rc_fingerprint(e),
     }
 
+def pending_thread_updates(recurse_ids):
+    """The events whose thread we've changed but haven't told RC about yet."""
+    if not recurse_ids:
+        return set()
+
+    event_id = OutboxMessage.payload['event_id'].as_integer()
+    rows = (
+        Session.query(event_id)
+        .filter(OutboxMessage.kind == OutboxMessage.RC_UPDATE)
+        .filter(OutboxMessage.next_attempt_at != None)
+        .filter(event_id.in_(recurse_ids))
+        .all()
+    )
+
+    return {row[0] for row in rows}
+
+def api_attributes(e, pending=None):
+    """event_dict(e) for updating an event we already have.
+
+    Leaves out the thread if our own change to it is still in the outbox, since
+    RC's copy is out of date until then. pending is pending_thread_updates for
+    a batch of events; it's looked up for just this one if not given.
+    """
+    attributes = event_dict(e)
+
+    if pending is None:
+        pending = pending_thread_updates([e['id']])
+
+    if e['id'] in pending:
+        del attributes['stream']
+        del attributes['subject']
+        # Only part of RC's data was applied, so look at all of it next time.
+        attributes['rc_fingerprint'] = None
+
+    return attributes
+
 def make_event(e):
     return Event(**event_dict(e))
 
@@ -188,6 +801,78 @@ def insert_event(e):
     Session.commit()
     return event
 
+INSERT_BATCH_SIZE = 1000
+
+def insert_new_events(events):
+    """Inserts the events from RC that we don't have yet, in a handful of statements.
+
+    The set-based version of make_event, Session.add_all and the Event
+    listeners: events we already have are skipped by ON CONFLICT, and an event
+    whose thread is taken, by an event we have or an earlier one in the batch,
+    is added without a thread and its thread is told why. Returns the
+    recurse_ids of the events that were added. Doesn't commit.
+    """
+    if not events:
+        return []
+
+    candidates = [make_event(e) for e in events]
+    rows = [event_dict(e) for e in events]
+
+    wanted = {(event.stream, event.subject) for event in candidates if event.already_initialized()}
+    owners = {}
+
+    if wanted:
+        owners = {
+            (stream, subject): recurse_id
+            for stream, subject, recurse_id in Session.query(Event.stream, Event.subject, Event.recurse_id).filter(tuple_(Event.stream, Event.subject).in_(wanted))
+        }
+
+    conflicts = set()
+
+    for event, row in zip(candidates, rows):
+        if event.already_initialized():
+            thread = (event.stream, event.subject)
+            owner = owners.setdefault(thread, event.recurse_id)
+
+            if owner != event.recurse_id:
+                conflicts.add(event.recurse_id)
+                row['stream'] = row['subject'] = None
+
+    inserted = set()
+
+    # Postgres allows at most 65535 parameters per statement.
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        inserted.update(Session.execute(
+            insert(Event.__table__)
+            .values(rows[i:i + INSERT_BATCH_SIZE])
+            .on_conflict_do_nothing(index_elements=['recurse_id'])
+            .returning(Event.__table__.c.recurse_id)
+        ).scalars())
+
+    messages = []
+    new_threads = set()
+
+    for event in candidates:
+        if event.recurse_id not in inserted:
+            continue
+
+        if event.recurse_id in conflicts:
+            messages.extend(thread_conflict_messages(event))
+            event.stream = event.subject = None
+        elif event.already_initialized():
+            new_threads.add((event.stream, event.subject))
+
+        messages.extend(init_messages(event))
+
+    session = Session()
+    enqueue_many(session.connection(), messages)
+    forget_threads(session, new_threads)
+
+    if messages:
+        session.info['outbox_written'] = True
+
+    return [event.recurse_id for event in candidates if event.recurse_id in inserted]
+
 def parse_time(event, attr, utc=False):
     if utc:
         tz = pytz.utc
@@ -195,19 +880,70 @@ def parse_time(event, attr, utc=False):
         tz = pytz.timezone(event['timezone'])
     return dateutil.parser.parse(event[attr]).astimezone(tz)
 
-def get_changes(obj):
-    state = inspect(obj)
-    changes = {}
+def event_exists(stream, subject):
+    return find_thread(stream, subject) is not None
 
-    for attr in state.attrs:
-        history = state.get_history(attr.key, True)
-        if history.has_changes():
-            changes[attr.key] = history.added
+def load_zulip_queue(bot_email):
+    """Returns (queue_id, last_event_id) for the bot's saved queue, or None."""
+    queue = Session.get(ZulipQueue, bot_email)
 
-    return changes
+    if queue is None:
+        return None
 
-def event_exists(stream, subject):
-    if stream and subject:
-        return Session.query(Event).filter(Event.stream == stream).filter(Event.subject == subject).count() > 0
-    else:
-        return False
+    return queue.queue_id, queue.last_event_id
+
+def save_zulip_queue(bot_email, queue_id, last_event_id):
+    values = {
+        'queue_id': queue_id,
+        'last_event_id': last_event_id,
+        'updated_at': sqlalchemy.func.now()
+    }
+
+    Session.execute(
+        insert(ZulipQueue)
+        .values(bot_email=bot_email, **values)
+        .on_conflict_do_update(index_elements=['bot_email'], set_=values)
+    )
+    Session.commit()
+
+def load_sync_cursor(name):
+    state = Session.get(SyncState, name)
+
+    if state is None:
+        return None
+
+    return state.cursor
+
+def save_sync_cursor(name, cursor):
+    """Moves a sync cursor forward, never back. Doesn't commit, so the cursor
+    is saved in the same transaction as whatever was read up to it."""
+    stmt = insert(SyncState).values(name=name, cursor=cursor, updated_at=sqlalchemy.func.now())
+
+    Session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={
+                'cursor': sqlalchemy.func.greatest(SyncState.cursor, stmt.excluded.cursor),
+                'updated_at': stmt.excluded.updated_at,
+            }
+        )
+    )
+
+def claim_message(message_id):
+    """Records that a Zulip message is being handled.
+
+    Returns False if it was already recorded, by this process or another one.
+    """
+    claimed = Session.execute(
+        insert(ProcessedMessage)
+        .values(message_id=message_id, processed_at=sqlalchemy.func.now())
+        .on_conflict_do_nothing(index_elements=['message_id'])
+        .returning(ProcessedMessage.message_id)
+    ).first()
+    Session.commit()
+
+    return claimed is not None
+
+def forget_processed_messages(older_than):
+    Session.query(ProcessedMessage).filter(ProcessedMessage.processed_at < older_than).delete(synchronize_session=False)
+    Session.commit()
@@ -0,0 +1,82 @@
+"""Postgres LISTEN/NOTIFY, for the bot and poller processes to talk to each other.
+
+There are two channels:
+
+- REFRESH: a bot asks the poller to refresh tracked events now, instead of
+  at its next scheduled run. The payload is the event's recurse_id.
+- INVALIDATE: whoever changed an event's thread tells every process to drop
+  its cached lookups for the old and new threads. The payload is a JSON list
+  of [stream, subject] pairs, or '*' for everything.
+
+Notifications sent inside a transaction are only delivered if it commits.
+"""
+import json
+import select
+import time
+import traceback
+
+from sqlalchemy import text
+
+REFRESH = 'rsvpbot_refresh'
+INVALIDATE = 'rsvpbot_invalidate'
+
+# Postgres refuses payloads of 8000 bytes or more.
+MAX_PAYLOAD = 7900
+
+def send(conn, channel, payload):
+    """Sends a notification on conn's current transaction."""
+    conn.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': channel, 'payload': payload})
+
+def request_refresh(conn, recurse_id):
+    send(conn, REFRESH, str(recurse_id))
+
+def threads_payload(keys):
+    payload = json.dumps(sorted([stream, subject] for stream, subject in keys))
+    return payload if len(payload) <= MAX_PAYLOAD else '*'
+
+def connect(engine):
+    """A connection of its own, outside the pool, since a listener holds it forever."""
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    conn = engine.dialect.connect(*cargs, **cparams)
+    conn.autocommit = True
+    return conn
+
+def listen(running, engine, handlers, on_connect=None):
+    """Calls handlers[channel](payload) for each notification until running is false.
+
+    Reconnects after errors. on_connect is called every time we start
+    listening, since anything sent while we weren't has been missed.
+    """
+    while running.value:
+        conn = None
+
+        try:
+            conn = connect(engine)
+            cursor = conn.cursor()
+
+            for channel in handlers:
+                cursor.execute('LISTEN {}'.format(channel))
+
+            if on_connect is not None:
+                on_connect()
+
+            while running.value:
+                # Wake up at least once a second to notice shutdowns.
+                if select.select([conn], [], [], 1) == ([], [], []):
+                    continue
+
+                conn.poll()
+
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+
+                    try:
+                        handlers[notification.channel](notification.payload)
+                    except Exception:
+                        print(traceback.format_exc())
+        except Exception:
+            print("Lost the connection for notifications:\n{}".format(traceback.format_exc()))
+            time.sleep(1)
+        finally:
+            if conn is not None:
+                conn.close()
@@ -0,0 +1,121 @@
+"""Sends the Zulip messages and RC updates that listeners in models.py queue up.
+
+Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so more than one
+drainer can run at once without sending anything twice. Within a batch,
+messages to the same Zulip thread (or updates to the same RC event) are sent
+in the order they were written. If one fails, the ones after it wait for its
+retry instead of overtaking it.
+"""
+from datetime import datetime, timedelta
+import sys
+import traceback
+
+import pytz
+import sqlalchemy
+
+import config
+import models
+import rc
+import tracing
+import zulip_util
+from models import OutboxMessage, Session
+
+class OutboxSendError(Exception):
+    pass
+
+def utcnow():
+    return datetime.utcnow().replace(tzinfo=pytz.utc)
+
+def retry_delay(attempts):
+    delay = config.outbox_retry_delay * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, config.outbox_max_retry_delay))
+
+def claim_batch(batch_size):
+    return (
+        Session.query(OutboxMessage)
+        .filter(OutboxMessage.next_attempt_at <= sqlalchemy.func.now())
+        .order_by(OutboxMessage.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+def send(message, zulip_client):
+    if message.kind == OutboxMessage.ZULIP:
+        with tracing.span('zulip', 'send_message'):
+            res = zulip_client.send_message(message.payload)
+
+        if res.get('result') != 'success':
+            raise OutboxSendError(res.get('msg', 'Zulip returned {}'.format(res)))
+    elif message.kind == OutboxMessage.RC_UPDATE:
+        rc.update_event(message.payload['event_id'], message.payload['updates'])
+    else:
+        raise OutboxSendError('unknown outbox message kind: {}'.format(message.kind))
+
+def failed(message, now, error):
+    message.attempts += 1
+    message.last_error = error
+
+    if message.attempts >= config.outbox_max_attempts:
+        print("Giving up on outbox message {} after {} attempts:\n{}".format(message.id, message.attempts, message.last_error))
+        message.next_attempt_at = None
+    else:
+        message.next_attempt_at = now + retry_delay(message.attempts)
+
+def drain(batch_size=None):
+    """Sends one batch of due outbox messages. Returns how many were claimed."""
+    batch = claim_batch(batch_size or config.outbox_batch_size)
+
+    if not batch:
+        Session.commit()
+        return 0
+
+    with tracing.trace('outbox', messages=len(batch)):
+        zulip_client = None
+        if any(message.kind == OutboxMessage.ZULIP for message in batch):
+            zulip_client = zulip_util.make_client()
+
+        now = utcnow()
+        waiting_on = {}
+
+        for message in batch:
+            key = message.ordering_key()
+
+            if key in waiting_on:
+                message.next_attempt_at = waiting_on[key]
+                continue
+
+            try:
+                send(message, zulip_client)
+            except Exception as e:
+                failed(message, now, repr(e))
+
+                if message.next_attempt_at is not None:
+                    waiting_on[key] = message.next_attempt_at
+            else:
+                Session.delete(message)
+
+        Session.commit()
+
+    return len(batch)
+
+def drain_or_wait():
+    """Drains a batch, then waits for new messages unless there may be more due."""
+    models.outbox_ready.clear()
+
+    try:
+        with models.session_scope('outbox batch'):
+            claimed = drain()
+    except Exception:
+        print(traceback.format_exc())
+        claimed = 0
+
+    if claimed < config.outbox_batch_size:
+        models.outbox_ready.wait(config.outbox_poll_interval)
+
+def run_outbox(running):
+    while running.value:
+        drain_or_wait()
+
+    print("Quitting outbox")
+    sys.exit()
@@ -1,78 +1,210 @@
 from datetime import datetime, timedelta
-import traceback
-import time
+from threading import Thread
 import sys
 
 import pytz
 
+import config
 import rc
 import models
+import notify
+import scheduler
+import tracing
 from models import Event, make_event, parse_time, Session
 
 def utcnow():
     return datetime.utcnow().replace(tzinfo=pytz.utc)
 
-def event_in(events, e):
-    for event in events:
-        if event.recurse_id == e['id']:
-            return True
-    return False
-
-def event_not_in(events, e):
-    return not event_in(events, e)
+# The sync_state row holding the created_at of the newest event we've read from RC.
+EVENTS_CURSOR = 'rc_events'
 
 def remove_known_events(events):
     if not events:
         return []
 
     ids = [e['id'] for e in events]
-    known_events = Session.query(Event).filter(Event.recurse_id.in_(ids)).all()
+    known = {recurse_id for (recurse_id,) in Session.query(Event.recurse_id).filter(Event.recurse_id.in_(ids))}
 
-    return [e for e in events if event_not_in(known_events, e)]
+    return [e for e in events if e['id'] not in known]
 
-def fetch_new_events():
-    oldest_event = Session.query(Event).order_by(Event._created_at.desc()).first()
+def events_cursor():
+    cursor = models.load_sync_cursor(EVENTS_CURSOR)
 
-    if oldest_event is not None:
-        created_at = oldest_event.created_at
-    else:
-        created_at = utcnow() - timedelta(days=60)
+    if cursor is not None:
+        return cursor
+
+    # Before the first sync, pick up from the newest event we already have.
+    newest_event = Session.query(Event).order_by(Event._created_at.desc()).first()
+
+    if newest_event is not None:
+        return newest_event.created_at
+
+    return utcnow() - timedelta(days=60)
+
+def fetch_future_events():
+    """Returns the upcoming events created since the cursor, or None if
+    nothing changed since the last poll.
+
+    RC filters out events that have already started, and so do we, in case
+    it ever ignores starts_at_or_after. The cursor is inclusive, so events
+    created at the same instant as the newest one we've seen are fetched
+    again and deduplicated by recurse_id.
 
+    starts_at_or_after is rounded down to the hour, so that the request, and
+    the validators it's looked up by, stay the same from one poll to the next.
+    """
     now = utcnow()
-    future_events = [e for e in rc.get_events(created_at_or_after=created_at) if parse_time(e, 'start_time') > now]
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    events = rc.get_events(created_at_or_after=events_cursor(), starts_at_or_after=hour, conditional=True)
 
-    return remove_known_events(future_events)
+    if events is None:
+        return None
+
+    return [e for e in events if parse_time(e, 'start_time') >= now]
 
 def fetch_and_insert_new_events():
-    events = fetch_new_events()
+    events = fetch_future_events()
+
+    if events is None:
+        return
+
+    if config.bulk_ingest:
+        # insert_new_events skips the events we already have.
+        models.insert_new_events(events)
+    else:
+        Session.add_all([make_event(e) for e in remove_known_events(events)])
+
     if events:
-        records = [make_event(e) for e in events]
-        Session.add_all(records)
-        Session.commit()
+        models.save_sync_cursor(EVENTS_CURSOR, max(parse_time(e, 'created_at', utc=True) for e in events))
+
+    Session.commit()
 
-def update_tracked_events():
-    tracked = Session.query(Event).filter(Event.stream != None).filter(Event.subject != None).filter(Event._start_time >= utcnow()).all()
+def update_tracked_events(starting_before=None):
+    """Refreshes the upcoming events that have a thread from RC, or only the
+    ones starting before starting_before."""
+    query = Session.query(Event).filter(Event.stream != None).filter(Event.subject != None).filter(Event._start_time >= utcnow())
+
+    if starting_before is not None:
+        query = query.filter(Event._start_time < starting_before)
+
+    tracked = query.all()
     ids = [event.recurse_id for event in tracked]
     by_id = {event.recurse_id: event for event in tracked}
 
     if ids:
-        for api_data in rc.get_events(ids=ids):
+        feed = 'tracked' if starting_before is None else 'imminent'
+        pending = models.pending_thread_updates(ids)
+        touched = skipped = 0
+
+        # Only events in chunks that changed since the last refresh come back.
+        for api_data in rc.get_events_by_id(ids, conditional=True, feed=feed):
             event = by_id[api_data['id']]
-            models.assign_attributes(event, models.event_dict(api_data))
+
+            if event.rc_fingerprint is not None and event.rc_fingerprint == models.rc_fingerprint(api_data):
+                skipped += 1
+                continue
+
+            models.assign_attributes(event, models.api_attributes(api_data, pending))
             Session.add(event)
+            touched += 1
 
         Session.commit()
 
+        tracing.annotate(touched=touched, skipped=skipped)
+
+        if touched or skipped:
+            print("Refreshed {} events: {} changed on RC, {} unchanged".format(feed, touched, skipped))
+
+def archive_past_events():
+    ended_before = utcnow() - timedelta(days=config.archive_after_days)
+
+    while models.archive_events(ended_before) == config.archive_batch_size:
+        pass
+
+def in_quiet_hours(now):
+    if not config.poll_quiet_hours:
+        return False
+
+    start, end = (int(hour) for hour in config.poll_quiet_hours.split('-'))
+    hour = now.astimezone(pytz.timezone(config.poll_timezone)).hour
+
+    if start <= end:
+        return start <= hour < end
+    else:
+        return hour >= start or hour < end
+
+def new_events_interval(now, newest_created_at):
+    """Polls less often for new events at night and the longer RC has gone without one."""
+    if in_quiet_hours(now):
+        return config.poll_new_events_max_interval
+
+    idle_hours = max(0, int((now - newest_created_at).total_seconds() // 3600))
+    return min(config.poll_new_events_interval * 2 ** min(idle_hours, 32), config.poll_new_events_max_interval)
+
+def polling_interval(seconds):
+    """With webhooks on, RC tells us about changes, so polling only has to
+    catch the ones a webhook missed."""
+    if config.webhook_port:
+        return max(seconds, config.webhook_reconcile_interval)
+
+    return seconds
+
+def sync_new_events():
+    fetch_and_insert_new_events()
+    return polling_interval(new_events_interval(utcnow(), events_cursor()))
+
+def refresh_imminent_events():
+    update_tracked_events(starting_before=utcnow() + timedelta(hours=1))
+
+def clean_up():
+    if config.archive_after_days:
+        archive_past_events()
+
+    if config.dedup_persist:
+        models.forget_processed_messages(utcnow() - timedelta(seconds=config.dedup_ttl))
+
+def forget_failed_work():
+    Session.rollback()
+    # What RC sent may not have been saved, so don't let it answer 304 next time.
+    rc.forget_validators()
+
+def job(name, f, interval):
+    def run():
+        with tracing.trace(name), models.session_scope(name):
+            try:
+                return f()
+            except Exception:
+                forget_failed_work()
+                raise
+
+    return scheduler.Job(name, run, interval)
+
+def make_scheduler():
+    jobs = [
+        job('new events', sync_new_events, polling_interval(config.poll_new_events_interval)),
+        job('tracked events', update_tracked_events, polling_interval(config.poll_tracked_events_interval)),
+        job('clean up', clean_up, config.poll_clean_up_interval),
+    ]
+
+    if not config.webhook_port:
+        jobs.append(job('imminent events', refresh_imminent_events, config.poll_imminent_events_interval))
+
+    return scheduler.Scheduler(jobs)
+
+def listen_for_refreshes(running, jobs):
+    """Runs the tracked events job right away when a bot asks for it with notify.REFRESH."""
+    listener = Thread(target=notify.listen, args=(running, models.engine, {
+        notify.REFRESH: lambda payload: jobs.run_soon('tracked events'),
+    }))
+    listener.start()
+    return listener
+
 def run_poller(running):
-    while running.value:
-        try:
-            fetch_and_insert_new_events()
-            update_tracked_events()
-        except Exception:
-            print(traceback.format_exc())
-            Session.rollback()
-
-        time.sleep(15)
+    jobs = make_scheduler()
+    listener = listen_for_refreshes(running, jobs)
+
+    jobs.run(running)
+    listener.join()
 
     print("Quitting poller")
     sys.exit()
@@ -1,11 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import json
+import threading
+import time
 
 import config
+import tracing
 
 class RCClientError(Exception):
     pass
 
+# The ETag and Last-Modified that RC last sent for each conditional request,
+# so that the same request can next ask for the response only if it changed.
+# Keyed by every parameter's value: validators from one cursor or set of ids
+# say nothing about another, and a Last-Modified sent with them could get a
+# 304 for events we've never seen. A feed name keeps apart callers that make
+# the same request for different purposes.
+validators = {}
+validators_lock = threading.Lock()
+
+def validator_key(path, params, feed=None):
+    return (path, tuple(sorted(params.items())), feed)
+
+def forget_validators():
+    """Makes the next conditional request fetch everything, e.g. after a poll fails."""
+    with validators_lock:
+        validators.clear()
+
 class Client:
     def __init__(self, id=None, secret=None, api_root=None):
         self.id = id or config.rc_client_id
@@ -20,16 +41,63 @@ class Client:
 
         return r.json()
 
-    def get_events(self, created_at_or_after=None, ids=None):
+    def get_events(self, created_at_or_after=None, starts_at_or_after=None, ids=None, conditional=False, feed=None):
+        """Returns the matching events. If conditional is True, returns None
+        when they haven't changed since the last conditional request like
+        this one for the same feed."""
         params = {}
 
         if created_at_or_after:
             params['created_at_or_after'] = created_at_or_after.isoformat()
 
+        if starts_at_or_after:
+            params['starts_at_or_after'] = starts_at_or_after.isoformat()
+
         if ids:
             params['ids'] = json.dumps(ids)
 
-        return self.get('events', params=params).json()
+        r = self.get('events', params=params, conditional=conditional, feed=feed)
+
+        if r.status_code == 304:
+            return None
+
+        if r.status_code != 200:
+            raise RCClientError(r.text)
+
+        return r.json()
+
+    def get_events_by_id(self, ids, conditional=False, feed=None):
+        """Yields the events with the given ids, in no particular order.
+
+        The ids are asked for rc_ids_per_request at a time, on up to
+        rc_max_concurrent_requests threads, and each chunk's events are
+        yielded as soon as it arrives. If conditional is True, chunks that
+        haven't changed since they were last fetched are skipped.
+        """
+        ids = sorted(ids)
+        size = config.rc_ids_per_request
+        chunks = [ids[i:i + size] for i in range(0, len(ids), size)]
+
+        if len(chunks) <= 1:
+            for chunk in chunks:
+                yield from self.get_events(ids=chunk, conditional=conditional, feed=feed) or []
+            return
+
+        def fetch(chunk):
+            started = time.perf_counter()
+            events = self.get_events(ids=chunk, conditional=conditional, feed=feed)
+            return events, (time.perf_counter() - started) * 1000
+
+        with ThreadPoolExecutor(min(len(chunks), config.rc_max_concurrent_requests), thread_name_prefix='rc') as executor:
+            futures = [executor.submit(fetch, chunk) for chunk in chunks]
+
+            for future in as_completed(futures):
+                events, duration_ms = future.result()
+
+                # The requests ran on other threads, outside the current trace.
+                tracing.record('rc', 'GET events', duration_ms, ids=len(events or []))
+
+                yield from events or []
 
     def join(self, event_id, zulip_id):
         return self.post_as_user('events/{}/join'.format(event_id), zulip_id).json()
@@ -38,30 +106,56 @@ class Client:
         return self.post_as_user('events/{}/leave'.format(event_id), zulip_id).json()
 
     def update_event(self, event_id, updates):
-        return self.patch('events/{}'.format(event_id), data={'event': updates}).json()
+        r = self.patch('events/{}'.format(event_id), data={'event': updates})
+
+        if r.status_code != 200:
+            raise RCClientError
+
+        return r.json()
 
     def post_as_user(self, path, zulip_id):
         auth = (self.id, self.secret)
         url = self.api_root + '/' + path
 
-        r = requests.post(url, auth=auth, data={'user_param': 'zulip_id', 'user_param_value': zulip_id})
+        with tracing.span('rc', 'POST ' + path):
+            r = requests.post(url, auth=auth, data={'user_param': 'zulip_id', 'user_param_value': zulip_id})
 
         if r.status_code != 200:
             raise RCClientError
 
         return r
 
-    def get(self, path, params={}):
+    def get(self, path, params={}, conditional=False, feed=None):
         auth = (self.id, self.secret)
         url = self.api_root + '/' + path
+        headers = {}
 
-        return requests.get(url, params=params, auth=auth)
+        if conditional:
+            key = validator_key(path, params, feed)
+
+            with validators_lock:
+                etag, last_modified = validators.get(key, (None, None))
+
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        with tracing.span('rc', 'GET ' + path):
+            r = requests.get(url, params=params, auth=auth, headers=headers)
+
+        if conditional and r.status_code == 200:
+            with validators_lock:
+                validators[key] = (r.headers.get('ETag'), r.headers.get('Last-Modified'))
+
+        return r
 
     def patch(self, path, data={}):
         auth = (self.id, self.secret)
         url = self.api_root + '/' + path
 
-        return requests.patch(url, json=data, auth=auth)
+        with tracing.span('rc', 'PATCH ' + path):
+            return requests.patch(url, json=data, auth=auth)
 
 def get_event(id, **kwargs):
     return Client().get_event(id, **kwargs)
@@ -69,6 +163,9 @@ def get_event(id, **kwargs):
 def get_events(**kwargs):
     return Client().get_events(**kwargs)
 
+def get_events_by_id(ids, **kwargs):
+    return Client().get_events_by_id(ids, **kwargs)
+
 def join(event_id, zulip_id):
     return Client().join(event_id, zulip_id)
 
@@ -4,6 +4,7 @@ import traceback
 
 import rsvp_commands
 import strings
+import tracing
 
 
 class RSVP(object):
@@ -36,6 +37,7 @@ class RSVP(object):
       # This needs to be at last for fuzzy yes|no checking
       rsvp_commands.RSVPConfirmCommand(key_word)
     )
+    self.router = CommandRouter(key_word, self.command_list)
 
   def process_message(self, message):
     """Processes the received message and returns a new message, to send back to the user."""
@@ -63,11 +65,12 @@ class RSVP(object):
     content = message['content']
     responses = []
     lines = normalize_whitespace(content)
+    snapshot = rsvp_commands.EventSnapshot()
     for line in lines:
-      responses.extend(self.route_internal(message, line))
+      responses.extend(self.route_internal(message, line, snapshot))
     return responses
 
-  def route_internal(self, message, content):
+  def route_internal(self, message, content, snapshot=None):
     """Route message to matching command.
 
     To be a valid rsvp command, the string must start with the string rsvp.
@@ -76,32 +79,38 @@ class RSVP(object):
     If there's absolutely no match, we return None, which, for the purposes of this program,
     means no reply.
     """
-    regex = r'^{}'.format(self.key_word)
-
-    if re.match(regex, content, flags=re.I):
-      for command in self.command_list:
-        matches = command.match(content)
-        if matches:
-          kwargs = {
-            'sender_email': message['sender_email'],
-            'sender_full_name': message['sender_full_name'],
-            'sender_id': message['sender_id'],
-            'stream': message['display_recipient'],
-            'subject': message['subject'],
-          }
-
-          if matches.groupdict():
-            kwargs.update(matches.groupdict())
-
-          try:
+    if self.router.is_command(content):
+      command, matches = self.router.match(content)
+      if command:
+        kwargs = {
+          'sender_email': message['sender_email'],
+          'sender_full_name': message['sender_full_name'],
+          'sender_id': message['sender_id'],
+          'stream': message['display_recipient'],
+          'subject': message['subject'],
+          'snapshot': snapshot,
+        }
+
+        if matches.groupdict():
+          kwargs.update(matches.groupdict())
+
+        try:
+          with tracing.span('command', type(command).__name__):
             response = command.execute(**kwargs)
-          except Exception:
-            print(traceback.format_exc())
-            response = rsvp_commands.RSVPCommandResponse(rsvp_commands.RSVPMessage("stream", strings.ERROR_SERVER_EXCEPTION))
+        except Exception:
+          print(traceback.format_exc())
+          response = rsvp_commands.RSVPCommandResponse(rsvp_commands.RSVPMessage("stream", strings.ERROR_SERVER_EXCEPTION))
+          mutated = True
+        else:
+          mutated = command.mutates
 
-          # if it has multiple messages to send, then return that instead of
-          # the pair
-          return response.messages
+        # later lines in this message need to see what this command changed
+        if snapshot and mutated:
+          snapshot.invalidate()
+
+        # if it has multiple messages to send, then return that instead of
+        # the pair
+        return response.messages
 
       return [rsvp_commands.RSVPMessage('private', strings.ERROR_INVALID_COMMAND % (content), message['sender_email'])]
     return [rsvp_commands.RSVPMessage('private', None)]
@@ -131,6 +140,63 @@ class RSVP(object):
     }
 
 
+class CommandRouter(object):
+  """Finds the command a line should run without trying every command in turn.
+
+  Commands are indexed by the first word after the key word (see
+  RSVPCommand.tokens). A line is only matched against the commands indexed
+  under its first word, plus the commands that could match anything (like the
+  fuzzy yes/no matcher), in their original order. The result is the same as
+  trying every command in order and taking the first match.
+  """
+
+  def __init__(self, key_word, commands):
+    self.key_word_regex = re.compile(r'^{}'.format(key_word), flags=re.I)
+    self.prefix_regex = re.compile(r'^{} '.format(key_word), flags=re.DOTALL | re.I)
+    self.first_word_regex = re.compile(r'\S*')
+
+    self.fallback = tuple(command for command in commands if command.tokens is None)
+    self.index = {}
+
+    for command in commands:
+      for token in command.tokens or ():
+        self.index[fold(token)] = ()
+
+    for token in self.index:
+      self.index[token] = tuple(
+        command for command in commands
+        if command.tokens is None or token in map(fold, command.tokens)
+      )
+
+  def is_command(self, content):
+    return self.key_word_regex.match(content)
+
+  def match(self, content):
+    """Returns the first matching command and its match object, or (None, None)."""
+    candidates = self.fallback
+    prefix = self.prefix_regex.match(content)
+
+    if prefix:
+      first_word = self.first_word_regex.match(content, prefix.end()).group()
+      candidates = self.index.get(fold(first_word), self.fallback)
+
+    for command in candidates:
+      matches = command.match(content)
+      if matches:
+        return command, matches
+
+    return None, None
+
+
+def fold(word):
+  """Case-folds a word so that two words are equal if re.IGNORECASE would match them.
+
+  casefold() handles everything re.IGNORECASE does except the Turkish dotted
+  and dotless i, which re matches against a plain 'i'.
+  """
+  return word.casefold().replace('i\u0307', 'i').replace('\u0131', 'i')
+
+
 def normalize_whitespace(content):
     """Strips trailing and leading whitespace from each line, and normalizes contiguous
     whitespace with a single space.
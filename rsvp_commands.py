@@ -7,6 +7,8 @@ import urllib.parse
 
 import strings
 import util
+import models
+import notify
 from models import Event, Session, insert_event, event_exists
 import rc
 import zulip_util
@@ -67,20 +69,77 @@ class RSVPCommandResponse(object):
         self.messages.append(arg)
 
 
+class EventSnapshot(object):
+  """Shares thread lookups and RC refreshes between the commands in one message.
+
+  RSVP.route makes one of these per message, so a message with several lines
+  for the same event only looks the event up and refreshes it from RC once.
+  Commands that change an event or its RSVPs have mutates = True, and RSVP
+  invalidates the snapshot after running them, so every command sees the same
+  data it would have if its line had been sent on its own.
+  """
+  def __init__(self):
+    self.threads = {}
+    self.refreshed = {}
+
+  def load(self, stream, subject, include_participants):
+    """Returns the event tracked in a thread and RC's data for it, or (None, None)."""
+    key = (stream, subject)
+
+    if key not in self.threads:
+      self.threads[key] = models.find_thread(stream, subject)
+
+    thread = self.threads[key]
+
+    if thread is None:
+      return None, None
+
+    # A response that includes participants is good enough for any command.
+    cached = self.refreshed.get(thread)
+
+    if cached and (cached[0] or not include_participants):
+      return cached[1], cached[2]
+
+    event, api_response = models.refresh_event(thread, include_participants)
+
+    if event is None:
+      # The event was deleted since we looked the thread up.
+      models.thread_cache.invalidate(stream, subject)
+      self.threads[key] = None
+      return None, None
+
+    self.refreshed[thread] = (include_participants, event, api_response)
+    return event, api_response
+
+  def invalidate(self):
+    self.threads.clear()
+    self.refreshed.clear()
+
+
 class RSVPCommand(object):
   """Base class for an RSVPCommand."""
   regex = None
 
+  # True if running the command can change an event or its RSVPs.
+  mutates = False
+
+  # The words that can come right after the prefix in a matching command, used
+  # by rsvp.CommandRouter to skip commands that can't match. None means the
+  # command could match anything, so it is always tried.
+  tokens = None
+
   def __init__(self, prefix, *args, **kwargs):
     # prefix is the command start the bot listens to, typically 'rsvp'
     self.prefix = r'^' + prefix + r' '
     self.regex = self.prefix + self.regex
+    self.pattern = re.compile(self.regex, flags=re.DOTALL | re.I)
 
   def match(self, input_str):
-    return re.match(self.regex, input_str, flags=re.DOTALL | re.I)
+    return self.pattern.match(input_str)
 
   def execute(self, *args, **kwargs):
     """execute() is just a convenience wrapper around __run()."""
+    kwargs.pop('snapshot', None)
     return self.run(*args, **kwargs)
 
 
@@ -91,18 +150,25 @@ class RSVPEventNeededCommand(RSVPCommand):
   def execute(self, *args, **kwargs):
     stream = kwargs.get('stream')
     subject = kwargs.get('subject')
+    snapshot = kwargs.pop('snapshot', None) or EventSnapshot()
 
-    event = Session.query(Event).filter(Event.stream == stream).filter(Event.subject == subject).first()
+    event, api_response = snapshot.load(stream, subject, self.include_participants)
 
     if event:
-      api_response = event.refresh_from_api(self.include_participants)
       return self.run(*args, **{**kwargs, "event": event, "api_response": api_response})
+
+    archived = models.find_archived_thread(stream, subject)
+
+    if archived:
+      title, url = archived
+      return RSVPCommandResponse(RSVPMessage('private', strings.ERROR_EVENT_ARCHIVED.format(title=title, url=url), kwargs.get('sender_email')))
     else:
       return RSVPCommandResponse(RSVPMessage('private', strings.ERROR_NOT_AN_EVENT, kwargs.get('sender_email')))
 
 
 class RSVPInitCommand(RSVPCommand):
   regex = r'init$'
+  tokens = ('init',)
 
   def run(self, *args, **kwargs):
     stream = kwargs['stream']
@@ -117,6 +183,8 @@ class RSVPInitCommand(RSVPCommand):
 
 class RSVPInitEventCommand(RSVPCommand):
   regex = r'init (?P<rc_id_or_url>.+)'
+  tokens = ('init',)
+  mutates = True
 
   def run(self, *args, **kwargs):
     stream = kwargs.pop('stream')
@@ -149,6 +217,10 @@ class RSVPInitEventCommand(RSVPCommand):
     if event.already_initialized():
       return RSVPCommandResponse(RSVPMessage('stream', strings.ERROR_EVENT_ALREADY_INITIALIZED.format(event.zulip_link())))
 
+    # The poller starts tracking the event now, not at its next scheduled
+    # refresh. Sent on the session's connection, so it arrives once the
+    # thread is saved, without taking a second connection from the pool.
+    notify.request_refresh(Session.connection(), event.recurse_id)
     event.update(stream=stream, subject=subject)
 
     return RSVPCommandResponse(RSVPMessage('stream', strings.MSG_INIT_SUCCESSFUL.format(event.title, event.url)))
@@ -156,6 +228,7 @@ class RSVPInitEventCommand(RSVPCommand):
 
 class RSVPHelpCommand(RSVPCommand):
   regex = r'help$'
+  tokens = ('help',)
 
   with open('README.md', 'r') as readme_file:
       readme_contents = readme_file.read()
@@ -168,6 +241,8 @@ class RSVPHelpCommand(RSVPCommand):
 
 class RSVPMoveCommand(RSVPEventNeededCommand):
   regex = r'move (?P<destination>.+)$'
+  tokens = ('move',)
+  mutates = True
 
   def run(self, *args, **kwargs):
     sender_id = kwargs.pop('sender_id')
@@ -183,7 +258,7 @@ class RSVPMoveCommand(RSVPEventNeededCommand):
 
       if stream is None or subject is None:
         body = strings.ERROR_BAD_MOVE_DESTINATION % destination
-      elif Session.query(Event).filter(Event.stream == stream).filter(Event.subject == subject).count() > 0:
+      elif event_exists(stream, subject):
         body = strings.ERROR_MOVE_ALREADY_AN_EVENT % destination_name
       else:
         event.update(stream=stream, subject=subject)
@@ -194,6 +269,8 @@ class RSVPMoveCommand(RSVPEventNeededCommand):
 
 
 class RSVPConfirmCommand(RSVPEventNeededCommand):
+  mutates = True
+
   yes_answers = (
     "ye(s+?)",
     "yea(h+?)",
@@ -305,10 +382,12 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
 
 class RSVPPingCommand(RSVPEventNeededCommand):
   regex = r'^({key_word} ping)$|({key_word} ping (?P<message>.+))$'
+  tokens = ('ping',)
   include_participants = True
 
   def __init__(self, prefix, *args, **kwargs):
     self.regex = self.regex.format(key_word=prefix)
+    self.pattern = re.compile(self.regex, flags=re.DOTALL | re.I)
 
   def run(self, *args, **kwargs):
     event = kwargs['event']
@@ -331,6 +410,7 @@ class RSVPPingCommand(RSVPEventNeededCommand):
 
 class RSVPCreditsCommand(RSVPCommand):
   regex = r'credits$'
+  tokens = ('credits',)
 
   def run(self, *args, **kwargs):
     sender_email = kwargs.pop('sender_email')
@@ -371,6 +451,7 @@ class RSVPCreditsCommand(RSVPCommand):
 
 class RSVPSummaryCommand(RSVPEventNeededCommand):
   regex = r'(summary$|status$)'
+  tokens = ('summary', 'status')
   include_participants = True
 
   def run(self, *args, **kwargs):
@@ -416,12 +497,15 @@ class RSVPSummaryCommand(RSVPEventNeededCommand):
 
 class RSVPCreateCalendarEventCommand(RSVPEventNeededCommand):
   regex = r'add to calendar$'
+  tokens = ('add',)
 
   def run(self, *args, **kwargs):
     event = kwargs.pop('event')
     return RSVPCommandResponse(RSVPMessage('stream', strings.ERROR_GOOGLE_CALENDAR_NO_LONGER_USED.format(event.url)))
 
 class RSVPFunctionalityMovedCommand(RSVPEventNeededCommand):
+  tokens = ('set',)
+
   def run(self, *args, **kwargs):
     return RSVPCommandResponse(RSVPMessage('stream', strings.ERROR_FUNCTIONALITY_MOVED.format(self.name, kwargs['event'].url)))
 
@@ -455,6 +539,7 @@ class RSVPSetDescriptionCommand(RSVPFunctionalityMovedCommand):
 
 class RSVPCancelCommand(RSVPFunctionalityMovedCommand):
   regex = r'cancel$'
+  tokens = ('cancel',)
   name = "cancel"
 
 class RSVPSetDurationCommand(RSVPFunctionalityMovedCommand):
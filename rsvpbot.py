@@ -5,10 +5,15 @@ load_dotenv(find_dotenv())
 from threading import Thread
 import traceback
 import signal
+import sys
 
 from bot import run_bot
 from poller import run_poller
+from outbox import run_outbox
+from webhooks import run_webhooks
 import atom
+import config
+import models
 
 running = atom.Atom(True)
 
@@ -26,19 +31,48 @@ def keep_alive(f, *args):
 
     return wrapped
 
-def start():
+ROLES = ('all', 'bot', 'poller')
+
+def start(role='all'):
+    """Runs the bot, the poller, or both (role 'all') in this process.
+
+    Separate bot and poller processes keep each other up to date through
+    Postgres notifications (see notify.py).
+    """
+    if role not in ROLES:
+        raise RuntimeError("Unknown role {!r}, expected one of: {}".format(role, ', '.join(ROLES)))
+
     signal.signal(signal.SIGTERM, shutdown)
     signal.signal(signal.SIGINT, shutdown)
 
-    bot = Thread(target=keep_alive(run_bot, running))
-    bot.start()
+    # Every process caches thread lookups, so every process listens for changes to them.
+    threads = [Thread(target=models.listen_for_thread_changes, args=(running,))]
+
+    if role in ('all', 'bot') and config.webhook_port:
+        threads.append(Thread(target=keep_alive(run_webhooks, running)))
+
+    if config.runtime == 'asyncio':
+        for thread in threads:
+            thread.start()
+
+        # Imported here so the threaded runtime never loads aiohttp.
+        from async_runtime import run_async
+        keep_alive(run_async, running, role)()
+        return
+
+    if role in ('all', 'bot'):
+        threads.append(Thread(target=keep_alive(run_bot, running)))
+        threads.append(Thread(target=keep_alive(run_outbox, running)))
+
+    if role in ('all', 'poller'):
+        threads.append(Thread(target=keep_alive(run_poller, running)))
 
-    poller = Thread(target=keep_alive(run_poller, running))
-    poller.start()
+    for thread in threads:
+        thread.start()
 
-    bot.join()
-    poller.join()
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == "__main__":
-    start()
+    start(sys.argv[1] if len(sys.argv) > 1 else config.role)
@@ -0,0 +1,76 @@
+"""Runs the poller's jobs, each on its own schedule.
+
+A job returns how many seconds to wait before it runs again, or None to keep
+its current interval. Every wait is lengthened or shortened by a random
+fraction of itself, up to jitter, so that jobs drift apart instead of calling
+RC at the same moment. A job that raises is retried after twice its interval,
+then four times, and so on up to max_backoff, until it succeeds again.
+"""
+import random
+import time
+import traceback
+
+import config
+
+class Job:
+    def __init__(self, name, run, interval):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.failures = 0
+        self.next_run_at = None
+
+class Scheduler:
+    def __init__(self, jobs, jitter=None, max_backoff=None, clock=time.monotonic, random=random.random):
+        self.jobs = jobs
+        self.jitter = config.poll_jitter if jitter is None else jitter
+        self.max_backoff = config.poll_max_backoff if max_backoff is None else max_backoff
+        self.clock = clock
+        self.random = random
+
+        now = self.clock()
+        for job in self.jobs:
+            job.next_run_at = now
+
+    def run_due(self):
+        """Runs every job that's due, the most overdue first."""
+        now = self.clock()
+
+        for job in sorted(self.jobs, key=lambda job: job.next_run_at):
+            if job.next_run_at <= now:
+                self.run_job(job)
+
+    def run_job(self, job):
+        try:
+            interval = job.run()
+        except Exception:
+            print(traceback.format_exc())
+            job.failures += 1
+            delay = min(job.interval * 2 ** min(job.failures, 32), self.max_backoff)
+            print("Job '{}' has failed {} time(s) in a row, retrying in {:.0f}s".format(job.name, job.failures, delay))
+        else:
+            job.failures = 0
+            if interval is not None:
+                job.interval = interval
+            delay = job.interval
+
+        job.next_run_at = self.clock() + self.jittered(delay)
+
+    def jittered(self, delay):
+        return delay * (1 + self.jitter * (2 * self.random() - 1))
+
+    def run_soon(self, name):
+        """Makes a job due now, e.g. when another process asks for it. Safe to call from any thread."""
+        for job in self.jobs:
+            if job.name == name:
+                job.next_run_at = self.clock()
+
+    def seconds_until_next(self):
+        return max(0, min(job.next_run_at for job in self.jobs) - self.clock())
+
+    def run(self, running, sleep=time.sleep):
+        while running.value:
+            self.run_due()
+
+            # Wake up at least once a second to notice shutdowns.
+            sleep(min(self.seconds_until_next(), 1))
@@ -2,45 +2,80 @@
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 
+import asyncio
 from collections import Counter
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 import dateutil.parser
+import itertools
+import json
 import os
 import os.path
+import queue
+import re
 import sys
 from contextlib import contextmanager
 import subprocess
+import tempfile
 import time
 import random
 
+import threading
 import unittest
 from unittest.mock import patch
 import xmlrunner
 
+import pytz
 import requests
 
+import async_runtime
+import atom
+import bot
+import cache
 import config
+import dedup
+import dispatcher
 import rc
 import rsvp
 import rsvp_commands
 import strings
 import models
+import notify
+import outbox
+import poller
+import scheduler
+import tracing
+import webhooks
+import zulip_util
 from models import Event, Session, make_event
 
 models.engine.echo = False
+rc_get_event = rc.get_event
+
+@contextmanager
+def count_statements():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    models.sqlalchemy.event.listen(models.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        models.sqlalchemy.event.remove(models.engine, 'before_cursor_execute', before_cursor_execute)
+
+def clear_outbox():
+    Session.query(models.OutboxMessage).delete()
+    Session.commit()
 
 class RSVPTest(unittest.TestCase):
     def setUp(self):
         super().setUp()
 
         requests.post('{}/reset'.format(config.rc_root))
-
-        p1 = patch('zulip_util.announce_event')
-        p2 = patch('zulip_util.send_message')
-        self.addCleanup(p1.stop)
-        self.addCleanup(p2.stop)
-        p1.start()
-        p2.start()
+        models.thread_cache.clear()
+        rc.forget_validators()
+        clear_outbox()
 
         self.rsvp = rsvp.RSVP('rsvp')
 
@@ -62,6 +97,7 @@ class RSVPTest(unittest.TestCase):
         for event in self._events:
             Session.delete(event)
         Session.commit()
+        clear_outbox()
 
     def create_input_message(
             self,
@@ -96,6 +132,763 @@ class RSVPInitTest(RSVPTest):
         output = self.issue_command('rsvp init {}'.format(self.test_data2['id']))
         self.assertIn('is already an RSVPBot event', output[0]['body'])
 
+class ThreadCacheTest(RSVPTest):
+    def test_no_queries_before_rc_in_an_event_thread(self):
+        self.issue_command('rsvp yes')
+
+        queries_before_rc = []
+        with count_statements() as statements, \
+                patch('rc.get_event', side_effect=lambda *args, **kwargs: queries_before_rc.extend(statements) or rc_get_event(*args, **kwargs)):
+            output = self.issue_command('rsvp yes')
+
+        self.assertIn('**You** are attending', output[0]['body'])
+        self.assertEqual([], queries_before_rc)
+
+    def test_no_queries_in_a_thread_without_an_event(self):
+        self.issue_command('rsvp yes', subject='Not an event')
+
+        with count_statements() as statements:
+            output = self.issue_command('rsvp yes', subject='Not an event')
+
+        self.assertEqual(strings.ERROR_NOT_AN_EVENT, output[0]['body'])
+        self.assertEqual([], statements)
+
+    def test_moving_an_event_invalidates_both_threads(self):
+        self.issue_command('rsvp yes', subject='New-Home')
+        self.issue_command('rsvp move http://testhost/#narrow/stream/test-stream/subject/New-Home')
+
+        output = self.issue_command('rsvp yes')
+        self.assertEqual(strings.ERROR_NOT_AN_EVENT, output[0]['body'])
+
+        output = self.issue_command('rsvp yes', subject='New-Home')
+        self.assertIn('**You** are attending', output[0]['body'])
+
+    def test_deleted_event(self):
+        self.issue_command('rsvp yes')
+
+        Session.delete(self.event)
+        Session.commit()
+        self._events.remove(self.event)
+
+        output = self.issue_command('rsvp yes')
+        self.assertEqual(strings.ERROR_NOT_AN_EVENT, output[0]['body'])
+
+class OutboxTest(RSVPTest):
+    def queued(self):
+        Session.expire_all()
+        return Session.query(models.OutboxMessage).order_by(models.OutboxMessage.id).all()
+
+    def zulip_client(self, *results):
+        client = unittest.mock.Mock()
+        client.send_message.side_effect = list(results)
+        return patch('zulip_util.make_client', return_value=client)
+
+    def change_title(self, title):
+        self.event.title = title
+        Session.commit()
+
+    def test_changes_are_queued_not_sent(self):
+        announcement, _, rc_update = self.queued()
+
+        self.assertEqual(models.OutboxMessage.ZULIP, announcement.kind)
+        self.assertEqual(zulip_util.announce_message(self.event), announcement.payload)
+
+        self.assertEqual(models.OutboxMessage.RC_UPDATE, rc_update.kind)
+        self.assertEqual({'event_id': self.event.recurse_id, 'updates': {'stream': 'test-stream', 'subject': 'Testing'}}, rc_update.payload)
+
+        self.assertIsNone(rc.get_event(self.event.recurse_id)['stream'])
+
+    def test_rolled_back_changes_queue_nothing(self):
+        clear_outbox()
+
+        self.event.title = 'A new title'
+        Session.flush()
+        self.assertEqual(1, len(self.queued()))
+
+        Session.rollback()
+        self.assertEqual([], self.queued())
+
+    @patch('zulip_util.get_names', return_value=[])
+    def test_refresh_keeps_a_thread_rc_doesnt_know_about_yet(self, mock_get_names):
+        output = self.issue_command('rsvp summary')
+
+        self.assertNotIn('not an RSVPBot event', output[0]['body'])
+        self.assertEqual('test-stream', self.event.stream)
+
+    def test_drain_sends_and_deletes(self):
+        self.issue_command('rsvp move http://testhost/#narrow/stream/test-stream/subject/Moved')
+
+        with self.zulip_client() as make_client:
+            make_client.return_value.send_message.side_effect = None
+            make_client.return_value.send_message.return_value = {'result': 'success'}
+            outbox.drain()
+
+        subjects = [args[0]['subject'] for args, _ in make_client.return_value.send_message.call_args_list]
+        self.assertEqual(['announce', 'announce'], subjects)
+        self.assertEqual([], self.queued())
+        self.assertEqual('Moved', rc.get_event(self.event.recurse_id)['subject'])
+
+    def test_failed_send_is_retried_in_order(self):
+        clear_outbox()
+        self.change_title('First')
+        self.change_title('Second')
+
+        with self.zulip_client({'result': 'error', 'msg': 'Zulip is down'}) as make_client:
+            outbox.drain()
+
+        self.assertEqual(1, make_client.return_value.send_message.call_count)
+
+        first, second = self.queued()
+        self.assertEqual(1, first.attempts)
+        self.assertIn('Zulip is down', first.last_error)
+        self.assertEqual(0, second.attempts)
+        self.assertEqual(first.next_attempt_at, second.next_attempt_at)
+        self.assertGreater(first.next_attempt_at, outbox.utcnow())
+
+        with self.zulip_client():
+            self.assertEqual(0, outbox.drain())
+
+        for message in self.queued():
+            message.next_attempt_at = outbox.utcnow()
+        Session.commit()
+
+        with self.zulip_client({'result': 'success'}, {'result': 'success'}) as make_client:
+            outbox.drain()
+
+        first, second = [args[0]['content'] for args, _ in make_client.return_value.send_message.call_args_list]
+        self.assertIn('First', first)
+        self.assertIn('Second', second)
+        self.assertEqual([], self.queued())
+
+    def test_gives_up_after_max_attempts(self):
+        clear_outbox()
+        self.change_title('New title')
+
+        with patch('config.outbox_max_attempts', 1), \
+                self.zulip_client({'result': 'error', 'msg': 'bad request'}):
+            outbox.drain()
+
+        [message] = self.queued()
+        self.assertEqual(1, message.attempts)
+        self.assertIsNone(message.next_attempt_at)
+
+    def test_thread_conflict_is_queued_despite_rollback(self):
+        clear_outbox()
+        data = dict(self.test_data2, id=self.test_data2['id'] + 1000, stream='test-stream', subject='Testing')
+
+        checked_out = []
+        enqueue_many = models.enqueue_many
+
+        def count_connections(conn, messages):
+            checked_out.append(models.engine.pool.checkedout())
+            enqueue_many(conn, messages)
+
+        with patch('models.enqueue_many', side_effect=count_connections):
+            Session.add(make_event(data))
+            with self.assertRaises(ValueError):
+                Session.commit()
+            Session.rollback()
+
+        # Queued after the session gave its connection back, not alongside it.
+        self.assertEqual([1], checked_out)
+
+        zulip_message, rc_update = self.queued()
+        self.assertIn("it's already tracking an event", zulip_message.payload['content'])
+        self.assertEqual({'event_id': data['id'], 'updates': {'stream': None, 'subject': None}}, rc_update.payload)
+
+class BulkIngestTest(RSVPTest):
+    def rc_event(self, offset, stream=None, subject=None):
+        return dict(self.test_data1, id=self.test_data1['id'] + offset, stream=stream, subject=subject)
+
+    def insert(self, events):
+        with count_statements() as statements:
+            inserted = models.insert_new_events(events)
+            Session.commit()
+
+        self._events.extend(Session.query(Event).filter(Event.recurse_id.in_(inserted)))
+        return inserted, statements
+
+    def queued(self):
+        return [message.payload for message in Session.query(models.OutboxMessage).order_by(models.OutboxMessage.id)]
+
+    def test_known_events_are_skipped(self):
+        clear_outbox()
+        inserted, _ = self.insert([self.test_data1, self.test_data2])
+
+        self.assertEqual([], inserted)
+        self.assertEqual([], self.queued())
+
+    def test_inserts_in_a_few_statements(self):
+        clear_outbox()
+        events = [self.rc_event(1000 + i) for i in range(300)]
+
+        inserted, statements = self.insert(events)
+
+        self.assertEqual([e['id'] for e in events], inserted)
+        self.assertLessEqual(len(statements), 3)
+        self.assertEqual(300, len(self.queued()))
+        self.assertTrue(all(payload['subject'] == config.rsvpbot_announce_subject for payload in self.queued()))
+
+    def test_thread_conflicts(self):
+        clear_outbox()
+        models.find_thread('new-stream', 'New-Thread')
+
+        taken = self.rc_event(1000, 'test-stream', 'Testing')
+        first = self.rc_event(1001, 'new-stream', 'New-Thread')
+        second = self.rc_event(1002, 'new-stream', 'New-Thread')
+
+        inserted, _ = self.insert([taken, first, second])
+        self.assertEqual([1000, 1001, 1002], [id - self.test_data1['id'] for id in inserted])
+
+        threads = {event.recurse_id: (event.stream, event.subject) for event in self._events}
+        self.assertEqual((None, None), threads[taken['id']])
+        self.assertEqual(('new-stream', 'New-Thread'), threads[first['id']])
+        self.assertEqual((None, None), threads[second['id']])
+        self.assertIsNotNone(models.find_thread('new-stream', 'New-Thread'))
+
+        queued = self.queued()
+        self.assertIn({'event_id': taken['id'], 'updates': {'stream': None, 'subject': None}}, queued)
+        self.assertIn({'event_id': second['id'], 'updates': {'stream': None, 'subject': None}}, queued)
+
+        conflict_notices = [p for p in queued if "it's already tracking an event" in p.get('content', '')]
+        self.assertEqual([('test-stream', 'Testing'), ('new-stream', 'New-Thread')], [(p['to'], p['subject']) for p in conflict_notices])
+
+        welcomes = [p for p in queued if 'is now an RSVPBot event' in p.get('content', '')]
+        self.assertEqual([('new-stream', 'New-Thread')], [(p['to'], p['subject']) for p in welcomes])
+
+        announcements = [p for p in queued if p.get('subject') == config.rsvpbot_announce_subject]
+        self.assertEqual(2, len(announcements))
+
+class ChangeSetTest(RSVPTest):
+    @contextmanager
+    def subscriber(self, *change_types):
+        calls = []
+        subscriber = models.on_change(*change_types)(lambda conn, event, changes: calls.append(changes))
+
+        try:
+            yield calls
+        finally:
+            models.change_subscribers.remove((change_types, subscriber))
+
+    def change_notices(self):
+        Session.expire_all()
+        return [
+            message.payload['content']
+            for message in Session.query(models.OutboxMessage).filter(models.OutboxMessage.kind == models.OutboxMessage.ZULIP)
+            if message.payload['subject'] == 'Testing'
+        ]
+
+    def test_built_once_per_update(self):
+        clear_outbox()
+        new_start = self.event.start_time + timedelta(hours=1)
+
+        with patch('models.ChangeSet.of', wraps=models.ChangeSet.of) as change_set:
+            self.event.title = 'New title'
+            self.event.start_time = new_start
+            Session.commit()
+
+        self.assertEqual(1, change_set.call_count)
+
+        [notice] = self.change_notices()
+        self.assertIn('The title has changed: New title', notice)
+        self.assertIn('The time has changed: ' + self.event.timestamp(), notice)
+
+    def test_typed_changes(self):
+        old_title, old_start = self.event.title, self.event._start_time
+
+        with self.subscriber(models.TitleChanged, models.TimeChanged, models.ThreadMoved) as calls:
+            self.event.title = 'New title'
+            self.event.start_time = old_start + timedelta(hours=1)
+            self.event.stream = 'other-stream'
+            self.event.subject = 'Other-Subject'
+            Session.commit()
+
+        [changes] = calls
+        self.assertEqual(models.TitleChanged(old_title, 'New title'), changes[models.TitleChanged])
+        self.assertEqual(old_start, changes[models.TimeChanged].old_start)
+        self.assertEqual(old_start + timedelta(hours=1), changes[models.TimeChanged].new_start)
+        self.assertEqual(models.ThreadMoved(('test-stream', 'Testing'), ('other-stream', 'Other-Subject')), changes[models.ThreadMoved])
+
+    def test_subscribers_only_see_their_changes(self):
+        with self.subscriber(models.ThreadMoved) as calls:
+            self.event.title = 'New title'
+            Session.commit()
+
+        self.assertEqual([], calls)
+
+    def test_unchanged_values_arent_changes(self):
+        clear_outbox()
+
+        with self.subscriber(models.TitleChanged, models.TimeChanged, models.ThreadMoved) as calls:
+            self.event.title = self.event.title
+            self.event.created_by = 'Someone else'
+            Session.commit()
+
+        self.assertEqual([], calls)
+        self.assertEqual([], self.change_notices())
+
+class ArchiveTest(RSVPTest):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.clear_archive)
+
+    def clear_archive(self):
+        Session.query(models.ArchivedEvent).delete()
+        Session.commit()
+        models.archived_threads.clear()
+
+    def end_days_ago(self, event, days):
+        event.start_time = poller.utcnow() - timedelta(days=days, hours=1)
+        event.end_time = poller.utcnow() - timedelta(days=days)
+        Session.commit()
+
+    def archive(self, days=30, **kwargs):
+        ids = {event: event.id for event in self._events}
+        moved = models.archive_events(poller.utcnow() - timedelta(days=days), **kwargs)
+        self._events = [event for event in self._events if Session.get(Event, ids[event]) is not None]
+        return moved
+
+    def test_moves_ended_events(self):
+        event_id, title = self.event.id, self.event.title
+        self.end_days_ago(self.event, 40)
+
+        self.assertEqual(1, self.archive())
+
+        self.assertIsNone(Session.get(Event, event_id))
+        archived = Session.get(models.ArchivedEvent, event_id)
+        self.assertEqual((title, 'test-stream', 'Testing'), (archived.title, archived.stream, archived.subject))
+        self.assertEqual([self.event2], self._events)
+
+    def test_keeps_recent_events(self):
+        self.end_days_ago(self.event, 10)
+        self.assertEqual(0, self.archive())
+
+    def test_batches(self):
+        self.end_days_ago(self.event, 40)
+        self.end_days_ago(self.event2, 50)
+
+        self.assertEqual(1, self.archive(limit=1))
+        self.assertEqual([self.event], self._events)
+
+        with patch('config.archive_batch_size', 1):
+            self._events = []
+            poller.archive_past_events()
+
+        self.assertEqual(2, Session.query(models.ArchivedEvent).count())
+
+    def test_commands_in_an_archived_thread(self):
+        self.issue_command('rsvp yes')
+        self.end_days_ago(self.event, 40)
+        self.archive()
+
+        output = self.issue_command('rsvp yes')
+        self.assertEqual(strings.ERROR_EVENT_ARCHIVED.format(title=self.test_data1['title'], url=self.test_data1['url']), output[0]['body'])
+
+        output = self.issue_command('rsvp yes', subject='Never an event')
+        self.assertEqual(strings.ERROR_NOT_AN_EVENT, output[0]['body'])
+
+        output = self.issue_command('rsvp init {}'.format(self.test_data2['url']))
+        self.assertIn('is now an RSVPBot event', output[0]['body'])
+
+class SyncTest(RSVPTest):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.clear_sync_state)
+
+    def clear_sync_state(self):
+        Session.query(models.SyncState).delete()
+        Session.commit()
+
+    def sync(self):
+        with patch('rc.get_events', wraps=rc.get_events) as get_events:
+            poller.fetch_and_insert_new_events()
+
+        self._events = Session.query(Event).order_by(Event.recurse_id).all()
+        return get_events.call_args.kwargs
+
+    def test_saves_the_cursor(self):
+        clear_outbox()
+        params = self.sync()
+
+        # The third devserver event is the only new one that hasn't started.
+        self.assertEqual([1, 2, 3], [event.recurse_id for event in self._events])
+        self.assertEqual(self.test_data1['created_at'], params['created_at_or_after'].isoformat())
+        self.assertGreater(params['starts_at_or_after'], poller.utcnow() - timedelta(hours=1))
+
+        newest = self._events[-1]
+        self.assertEqual(newest.created_at, models.load_sync_cursor(poller.EVENTS_CURSOR))
+
+        # The new event is announced through the outbox, not sent straight to Zulip.
+        queued = Session.query(models.OutboxMessage).all()
+        self.assertEqual([(models.OutboxMessage.ZULIP, zulip_util.announce_message(newest))], [(m.kind, m.payload) for m in queued])
+
+        params = self.sync()
+        self.assertEqual(newest.created_at, params['created_at_or_after'])
+        self.assertEqual(3, len(self._events))
+
+    def test_cursor_never_moves_back(self):
+        now = poller.utcnow()
+        models.save_sync_cursor(poller.EVENTS_CURSOR, now)
+        models.save_sync_cursor(poller.EVENTS_CURSOR, now - timedelta(days=1))
+        Session.commit()
+
+        self.assertEqual(now, models.load_sync_cursor(poller.EVENTS_CURSOR))
+
+    def test_without_bulk_ingest(self):
+        with patch('config.bulk_ingest', False):
+            self.sync()
+
+        self.assertEqual([1, 2, 3], [event.recurse_id for event in self._events])
+
+    def test_started_events_are_skipped_even_if_rc_sends_them(self):
+        started = dict(self.test_data2, id=1000, start_time=self.test_data1['start_time'])
+
+        with patch('rc.get_events', return_value=[started, self.test_data2]):
+            self.assertEqual([self.test_data2], poller.fetch_future_events())
+
+    def test_remove_known_events(self):
+        new = dict(self.test_data2, id=1000)
+        self.assertEqual([new], poller.remove_known_events([self.test_data1, new, self.test_data2]))
+
+class ConditionalGetTest(RSVPTest):
+    def test_unchanged_events_are_not_sent_again(self):
+        ids = [self.test_data1['id'], self.test_data2['id']]
+
+        self.assertEqual(2, len(rc.get_events(ids=ids, conditional=True)))
+        self.assertIsNone(rc.get_events(ids=ids, conditional=True))
+        self.assertEqual(2, len(rc.get_events(ids=ids)))
+
+        rc.update_event(self.test_data2['id'], {'subject': 'Moved'})
+        self.assertEqual(2, len(rc.get_events(ids=ids, conditional=True)))
+
+    def test_different_ids_are_not_conditional(self):
+        self.assertEqual([self.test_data1['id']], [e['id'] for e in rc.get_events_by_id([self.test_data1['id']], conditional=True, feed='tracked')])
+
+        # Newly tracked events get a chunk of their own ids, which RC hasn't sent before.
+        with patch('requests.get', wraps=requests.get) as get:
+            events = list(rc.get_events_by_id([self.test_data2['id']], conditional=True, feed='tracked'))
+
+        self.assertNotIn('If-None-Match', get.call_args.kwargs['headers'])
+        self.assertEqual([self.test_data2['id']], [e['id'] for e in events])
+
+    def test_poll_skips_unchanged_events(self):
+        # The first poll finds a new event and moves the cursor, so the second
+        # is a new request. After that, nothing changes until RC does.
+        poller.fetch_and_insert_new_events()
+        poller.fetch_and_insert_new_events()
+        self._events = Session.query(Event).all()
+
+        with patch('models.insert_new_events') as insert_new_events:
+            poller.fetch_and_insert_new_events()
+            insert_new_events.assert_not_called()
+
+            requests.post('{}/create'.format(config.rc_root))
+            poller.fetch_and_insert_new_events()
+            insert_new_events.assert_called_once()
+
+    def test_failed_job_rolls_back_and_forgets_validators(self):
+        event_id, title = self.event2.id, self.event2.title
+
+        def insert_new_events(events):
+            self.assertNotEqual({}, rc.validators)
+            Session.get(Event, event_id).title = 'Never saved'
+            Session.flush()
+            raise RuntimeError('boom')
+
+        requests.post('{}/create'.format(config.rc_root))
+        job = poller.job('new events', poller.sync_new_events, 15)
+
+        with patch('models.insert_new_events', side_effect=insert_new_events):
+            self.assertRaises(RuntimeError, job.run)
+
+        self.assertEqual({}, rc.validators)
+        self.assertEqual(title, Session.query(Event.title).filter(Event.id == event_id).scalar())
+
+class ChunkedFetchTest(RSVPTest):
+    def setUp(self):
+        super().setUp()
+
+        for _ in range(3):
+            requests.post('{}/create'.format(config.rc_root))
+
+        self.ids = list(range(1, 7))
+
+    def fetch(self, **kwargs):
+        with patch('config.rc_ids_per_request', 2), patch('requests.get', wraps=requests.get) as get:
+            events = list(rc.get_events_by_id(self.ids, **kwargs))
+
+        return sorted(e['id'] for e in events), get.call_count
+
+    def test_fetches_in_chunks(self):
+        self.assertEqual((self.ids, 3), self.fetch())
+
+    def test_skips_unchanged_chunks(self):
+        self.assertEqual((self.ids, 3), self.fetch(conditional=True, feed='tracked'))
+        self.assertEqual(([], 3), self.fetch(conditional=True, feed='tracked'))
+
+        rc.update_event(5, {'subject': 'Moved'})
+        self.assertEqual(([5, 6], 3), self.fetch(conditional=True, feed='tracked'))
+
+    def test_too_many_ids(self):
+        with self.assertRaises(rc.RCClientError):
+            rc.get_events(ids=list(range(101)))
+
+        self.assertEqual(self.ids, sorted(e['id'] for e in rc.get_events_by_id(list(range(1, 102)))))
+
+class FingerprintTest(RSVPTest):
+    def setUp(self):
+        super().setUp()
+
+        rc.update_event(self.test_data2['id'], {'stream': 'test-stream', 'subject': 'Soon'})
+        self.event2.stream, self.event2.subject = 'test-stream', 'Soon'
+        Session.commit()
+        clear_outbox()
+
+    def refresh(self):
+        rc.forget_validators()
+
+        with count_statements() as statements, patch('builtins.print') as print:
+            poller.update_tracked_events()
+
+        updates = [s for s in statements if s.startswith('UPDATE')]
+        return updates, print.call_args.args[0]
+
+    def test_unchanged_events_are_skipped(self):
+        updates, logged = self.refresh()
+        self.assertEqual(1, len(updates))
+        self.assertEqual("Refreshed tracked events: 1 changed on RC, 0 unchanged", logged)
+
+        updates, logged = self.refresh()
+        self.assertEqual([], updates)
+        self.assertEqual("Refreshed tracked events: 0 changed on RC, 1 unchanged", logged)
+
+        rc.update_event(self.test_data2['id'], {'subject': 'Later'})
+        updates, logged = self.refresh()
+        self.assertEqual(1, len(updates))
+        self.assertEqual('Later', self.event2.subject)
+
+    def test_pending_thread_updates_are_not_fingerprinted(self):
+        data = rc.get_event(self.test_data2['id'])
+
+        self.assertEqual(models.rc_fingerprint(data), models.api_attributes(data, set())['rc_fingerprint'])
+        self.assertIsNone(models.api_attributes(data, {data['id']})['rc_fingerprint'])
+
+    def test_local_thread_changes_forget_the_fingerprint(self):
+        self.refresh()
+        self.assertIsNotNone(self.event2.rc_fingerprint)
+
+        self.event2.subject = 'Moved'
+        Session.commit()
+        self.assertIsNone(self.event2.rc_fingerprint)
+
+        # The outbox gives up on telling RC, so RC's thread wins.
+        Session.query(models.OutboxMessage).update({'next_attempt_at': None})
+        Session.commit()
+
+        updates, logged = self.refresh()
+        self.assertEqual("Refreshed tracked events: 1 changed on RC, 0 unchanged", logged)
+        self.assertEqual('Soon', self.event2.subject)
+        self.assertEqual(models.rc_fingerprint(rc.get_event(self.test_data2['id'])), self.event2.rc_fingerprint)
+
+class WebhookTest(RSVPTest):
+    def setUp(self):
+        super().setUp()
+
+        p = patch('config.webhook_secret', 'secret')
+        p.start()
+        self.addCleanup(p.stop)
+
+        server = webhooks.make_server(0)
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.url = 'http://localhost:{}{}'.format(server.server_address[1], webhooks.WEBHOOK_PATH)
+        requests.post('{}/webhooks'.format(config.rc_root), data={'url': self.url, 'secret': 'secret'})
+        self.addCleanup(requests.post, '{}/webhooks'.format(config.rc_root), data={'url': ''})
+
+    def post(self, event, secret='secret'):
+        body = json.dumps({'action': 'updated', 'event': event}).encode()
+        return requests.post(self.url, data=body, headers={'X-RC-Signature': webhooks.sign(body, secret)})
+
+    def test_new_events_are_added(self):
+        requests.post('{}/create'.format(config.rc_root))
+
+        event = Session.query(Event).filter(Event.recurse_id == 4).one()
+        self._events.append(event)
+
+    def test_updates_are_applied(self):
+        rc.update_event(self.test_data2['id'], {'stream': 'test-stream', 'subject': 'Pushed'})
+
+        Session.expire_all()
+        self.assertEqual(('test-stream', 'Pushed'), (self.event2.stream, self.event2.subject))
+
+    def test_unchanged_events(self):
+        data = rc.get_event(self.test_data2['id'])
+        self.assertEqual({'result': 'unchanged'}, self.post(data).json())
+
+        with patch('models.assign_attributes') as assign_attributes:
+            rc.join(self.test_data2['id'], 808)
+            assign_attributes.assert_not_called()
+
+        renamed = dict(data, title='Renamed')
+        self.assertEqual({'result': 'updated'}, self.post(renamed).json())
+
+        Session.expire_all()
+        self.assertEqual('Renamed', self.event2.title)
+        self.assertEqual(models.rc_fingerprint(renamed), self.event2.rc_fingerprint)
+
+    def test_past_events_are_ignored(self):
+        data = dict(self.test_data1, id=1000)
+        self.assertEqual({'result': 'ignored'}, self.post(data).json())
+
+    def test_bad_signature(self):
+        response = self.post(rc.get_event(self.test_data2['id']), secret='wrong')
+        self.assertEqual(401, response.status_code)
+
+    def test_body_too_large(self):
+        data = rc.get_event(self.test_data2['id'])
+
+        with patch('webhooks.MAX_BODY_SIZE', 100), patch('webhooks.apply_event') as apply_event:
+            response = self.post(data)
+
+        self.assertEqual(413, response.status_code)
+        apply_event.assert_not_called()
+
+    def test_polls_slowly(self):
+        with patch('config.webhook_port', 8000):
+            jobs = poller.make_scheduler()
+
+        self.assertEqual(['new events', 'tracked events', 'clean up'], [job.name for job in jobs.jobs])
+        self.assertEqual([600, 600, 300], [job.interval for job in jobs.jobs])
+
+class NotifyTest(RSVPTest):
+    def listen(self, channel):
+        received = queue.Queue()
+        running = atom.Atom(True)
+        connected = threading.Event()
+
+        thread = threading.Thread(target=notify.listen, args=(running, models.engine, {channel: received.put}), kwargs={'on_connect': connected.set})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(setattr, running, 'value', False)
+
+        self.assertTrue(connected.wait(5))
+        return received
+
+    def test_thread_changes_are_sent(self):
+        received = self.listen(notify.INVALIDATE)
+        self.issue_command('rsvp move http://testhost/#narrow/stream/other-stream/subject/Other')
+
+        self.assertEqual([['other-stream', 'Other'], ['test-stream', 'Testing']], json.loads(received.get(timeout=5)))
+
+    def test_rolled_back_changes_are_not_sent(self):
+        received = self.listen(notify.INVALIDATE)
+
+        self.event.stream, self.event.subject = 'other-stream', 'Other'
+        Session.flush()
+        Session.rollback()
+
+        with models.engine.begin() as conn:
+            notify.send(conn, notify.INVALIDATE, 'committed')
+
+        self.assertEqual('committed', received.get(timeout=5))
+
+    def test_other_processes_forget_threads(self):
+        models.find_thread('test-stream', 'Testing')
+        models.find_thread('other-stream', 'Other')
+        self.assertIn(('test-stream', 'Testing'), models.thread_cache.entries)
+
+        models.forget_notified_threads(json.dumps([['test-stream', 'Testing']]))
+        self.assertNotIn(('test-stream', 'Testing'), models.thread_cache.entries)
+        self.assertIn(('other-stream', 'Other'), models.thread_cache.entries)
+
+        models.forget_notified_threads('*')
+        self.assertEqual(0, len(models.thread_cache.entries))
+
+    def test_init_asks_for_a_refresh(self):
+        received = self.listen(notify.REFRESH)
+        self.issue_command('rsvp init {}'.format(self.test_data2['id']), subject='Another')
+
+        self.assertEqual(str(self.test_data2['id']), received.get(timeout=5))
+
+class PollScheduleTest(RSVPTest):
+    def at(self, hour):
+        return pytz.timezone(config.poll_timezone).localize(datetime(2017, 5, 17, hour)).astimezone(pytz.utc)
+
+    def test_new_events_interval(self):
+        noon = self.at(12)
+
+        self.assertEqual(15, poller.new_events_interval(noon, noon - timedelta(minutes=10)))
+        self.assertEqual(60, poller.new_events_interval(noon, noon - timedelta(hours=2, minutes=10)))
+        self.assertEqual(300, poller.new_events_interval(noon, noon - timedelta(days=60)))
+        self.assertEqual(300, poller.new_events_interval(self.at(3), self.at(3)))
+
+        with patch('config.poll_quiet_hours', '22-7'):
+            self.assertEqual(300, poller.new_events_interval(self.at(23), self.at(23)))
+            self.assertEqual(15, poller.new_events_interval(self.at(7), self.at(7)))
+
+        with patch('config.poll_quiet_hours', ''):
+            self.assertEqual(15, poller.new_events_interval(self.at(3), self.at(3)))
+
+    def test_refreshes_imminent_events(self):
+        self.event2.stream, self.event2.subject = 'test-stream', 'Soon'
+        Session.commit()
+
+        with patch('rc.get_events_by_id', wraps=rc.get_events_by_id) as get_events_by_id:
+            poller.refresh_imminent_events()
+            get_events_by_id.assert_not_called()
+
+            self.event2.start_time = poller.utcnow() + timedelta(minutes=30)
+            Session.commit()
+
+            poller.refresh_imminent_events()
+            get_events_by_id.assert_called_once_with([self.test_data2['id']], conditional=True, feed='imminent')
+
+class RenderCacheTest(RSVPTest):
+    def test_rendered_once(self):
+        self.event.timestamp()
+
+        with patch('pytz.timezone') as timezone:
+            self.event.timestamp()
+            self.event.zulip_link()
+            self.event.start_time
+            self.event.end_time
+
+        timezone.assert_not_called()
+
+    def test_setting_times_rerenders(self):
+        before = self.event.timestamp()
+
+        self.event.start_time = self.event.start_time - timedelta(hours=1)
+        self.assertNotEqual(before, self.event.timestamp())
+
+        before = self.event.timestamp()
+        self.event.end_time = self.event.end_time + timedelta(hours=1)
+        self.assertNotEqual(before, self.event.timestamp())
+
+        before = self.event.timestamp()
+        self.event.timezone = 'Asia/Tokyo'
+        self.assertNotEqual(before, self.event.timestamp())
+        self.assertIn('JST', self.event.timestamp())
+
+    def test_moving_rerenders_link(self):
+        self.event.zulip_link()
+        self.event.stream = 'other-stream'
+        self.event.subject = 'Other-Subject'
+
+        self.assertEqual('**[#other-stream > Other-Subject]({})**'.format(zulip_util.stream_topic_to_narrow_url('other-stream', 'Other-Subject')), self.event.zulip_link())
+
+    def test_reloading_rerenders(self):
+        self.event.timestamp()
+
+        Session.execute(models.sqlalchemy.text("UPDATE events SET timezone = 'Asia/Tokyo' WHERE id = :id"), {'id': self.event.id})
+        Session.commit()
+
+        self.assertIn('JST', self.event.timestamp())
+
 class RSVPFunctionalityMovedTest(RSVPTest):
     def test_functionality_moved(self):
         commands = [
@@ -378,6 +1171,901 @@ rsvp no
         self.assertEqual(None, output[1])
         self.assertIn('You are **not** attending', output[2]['body'])
 
+    @patch('zulip_util.get_names', return_value=['Test User'])
+    def test_rsvp_multiple_commands_share_one_refresh(self, mock_get_names):
+        commands = """
+rsvp summary
+rsvp status
+rsvp add to calendar
+"""
+
+        with patch('rc.get_event', wraps=rc.get_event) as get_event:
+            output = self.issue_command(commands)
+
+        self.assertEqual(3, len(output))
+        self.assertEqual(1, get_event.call_count)
+
+    def test_rsvp_multiple_commands_match_single_commands(self):
+        lines = ['rsvp summary', 'rsvp yes', 'rsvp summary', 'rsvp no', 'rsvp status']
+
+        with patch('random.random', return_value=0.5), \
+                patch('zulip_util.get_names', side_effect=lambda ids: ['User %d' % id for id in ids]):
+            self.issue_command('rsvp no')
+            one_at_a_time = [self.issue_command(line)[0] for line in lines]
+            together = self.issue_command('\n'.join(lines))
+
+        self.assertEqual(one_at_a_time, together)
+        self.assertNotEqual(together[0]['body'], together[2]['body'])
+
+
+def linear_match(rsvp_instance, content):
+    """The routing RSVP.route_internal did before CommandRouter: try every command in order."""
+    if not re.match(r'^{}'.format(rsvp_instance.key_word), content, flags=re.I):
+        return 'not a command'
+
+    for command in rsvp_instance.command_list:
+        matches = re.match(command.regex, content, flags=re.DOTALL | re.I)
+        if matches:
+            return type(command), matches.groupdict()
+
+    return None
+
+def routed_match(rsvp_instance, content):
+    if not rsvp_instance.router.is_command(content):
+        return 'not a command'
+
+    command, matches = rsvp_instance.router.match(content)
+    if command:
+        return type(command), matches.groupdict()
+
+    return None
+
+class RSVPRouterTest(unittest.TestCase):
+    words = [
+        'init', 'help', 'move', 'summary', 'status', 'ping', 'credits', 'cancel',
+        'set', 'limit', 'date', 'time', 'allday', 'duration', 'location', 'place',
+        'description', 'add', 'to', 'calendar', 'yes', 'no', 'maybe', 'nah', 'yasss',
+        ':thumbsup:', ':-1:', 'y', 'n', 'nose', 'yesterday', '5', '10:30', 'foo',
+        'https://www.recurse.com/calendar/123', 'http://testhost/#narrow/stream/a/subject/b',
+        'INIT', 'Summary', 'PiNg', '\u0130NIT', '\u0131nit', '\u017fummary', 'caNceL',
+        'initx', 'set\tlimit', '', ' ',
+    ]
+
+    def assertRoutesLikeLinearScan(self, rsvp_instance, lines):
+        for line in lines:
+            self.assertEqual(linear_match(rsvp_instance, line), routed_match(rsvp_instance, line), repr(line))
+
+    def test_every_command(self):
+        lines = [
+            'rsvp init', 'rsvp init 123', 'rsvp help', 'rsvp move http://testhost/#narrow/stream/a/subject/b',
+            'rsvp summary', 'rsvp status', 'rsvp ping', 'rsvp ping hi all', 'rsvp credits', 'rsvp cancel',
+            'rsvp set limit 5', 'rsvp set date tomorrow', 'rsvp set time 10:30', 'rsvp set time allday',
+            'rsvp set duration 1h', 'rsvp set location here', 'rsvp set place there',
+            'rsvp set description fun', 'rsvp add to calendar', 'rsvp yes', 'rsvp no', 'rsvp maybe',
+            'rsvp', 'rsvpyes', 'rsvp  yes', 'hello rsvp yes', 'RSVP YES', 'rsvp init\n', 'rsvp help\nmore',
+        ]
+        self.assertRoutesLikeLinearScan(rsvp.RSVP('rsvp'), lines)
+
+    def test_word_combinations(self):
+        # Every one- and two-word line, and the same sample of three-word lines on every run.
+        sample = random.Random(0)
+        lines = [
+            'rsvp ' + ' '.join(combo)
+            for n in range(1, 4)
+            for combo in itertools.product(self.words, repeat=n)
+            if n < 3 or sample.random() < 0.05
+        ]
+        self.assertRoutesLikeLinearScan(rsvp.RSVP('rsvp'), lines)
+
+    def test_other_key_words(self):
+        lines = ['{} {}'.format(prefix, word) for prefix in ['rsvptest', 'RSVPTEST', 'rsvp'] for word in self.words]
+        self.assertRoutesLikeLinearScan(rsvp.RSVP('rsvptest'), lines)
+
+
+class CommandFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.command_filter = bot.command_filter('rsvp')
+        self.rsvp = rsvp.RSVP('rsvp')
+
+    def test_finds_commands(self):
+        for content in ['rsvp yes', 'RSVP no', '  rsvp yes  ', 'hi!\n\t rsvp yes\nthanks', 'rsvpfoo']:
+            self.assertTrue(self.command_filter.search(content), repr(content))
+
+    def test_skipped_messages_get_no_reply(self):
+        for content in ['', 'hello', 'please rsvp yes', 'yes\nno', 'hi\n\n  say rsvp', ':thumbsup: rsvp']:
+            self.assertFalse(self.command_filter.search(content), repr(content))
+
+            message = RSVPTest.create_input_message(self, content=content)
+            self.assertTrue(all(reply.body is None for reply in self.rsvp.route(message)))
+
+
+def mock_zulip_client(streams=(), subscriptions=()):
+    client = unittest.mock.Mock()
+    client.get_streams.return_value = {'result': 'success', 'streams': [{'name': name} for name in streams]}
+    client.get_subscriptions.return_value = {'result': 'success', 'subscriptions': [{'name': name} for name in subscriptions]}
+    client.register.return_value = {'result': 'success', 'queue_id': 'queue-1', 'last_event_id': -1}
+    return client
+
+class BotTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mock_zulip_client()
+
+    def tearDown(self):
+        Session.query(models.ZulipQueue).delete()
+        Session.commit()
+
+    def make_bot(self, subscribed_streams=None):
+        with patch('zulip.Client', return_value=self.client):
+            return bot.Bot(atom.Atom(True), 'bot@example.com', 'key', 'rsvp', subscribed_streams)
+
+    def test_subscribes_only_to_missing_streams(self):
+        self.client = mock_zulip_client(streams=['general', 'events', 'social'], subscriptions=['events'])
+        instance = self.make_bot()
+
+        # Only a new queue needs the whole realm's streams.
+        self.client.get_streams.assert_not_called()
+        instance.register()
+
+        self.client.add_subscriptions.assert_called_once_with([{'name': 'general'}, {'name': 'social'}])
+        self.assertEqual({'general', 'events', 'social'}, instance.subscriptions)
+
+    def test_nothing_to_subscribe_to(self):
+        self.client = mock_zulip_client(streams=['events'], subscriptions=['events'])
+        self.make_bot().register()
+
+        self.client.add_subscriptions.assert_not_called()
+
+    def test_new_streams_are_subscribed_to(self):
+        self.client = mock_zulip_client(streams=['events'], subscriptions=['events'])
+        instance = self.make_bot()
+
+        instance.process({'type': 'stream', 'op': 'create', 'streams': [{'name': 'events'}, {'name': 'new'}]})
+
+        self.client.add_subscriptions.assert_called_once_with([{'name': 'new'}])
+        self.assertEqual({'events', 'new'}, instance.subscriptions)
+
+    def test_subscription_events_update_subscriptions(self):
+        self.client = mock_zulip_client(streams=['events'], subscriptions=['events'])
+        instance = self.make_bot()
+
+        instance.process({'type': 'subscription', 'op': 'add', 'subscriptions': [{'name': 'general'}]})
+        self.assertEqual({'events', 'general'}, instance.subscriptions)
+
+        instance.process({'type': 'subscription', 'op': 'remove', 'subscriptions': [{'name': 'events'}]})
+        self.assertEqual({'general'}, instance.subscriptions)
+
+        self.client.add_subscriptions.assert_not_called()
+
+    def test_configured_streams_are_not_added_to(self):
+        self.client = mock_zulip_client(streams=['general', 'events', 'social'], subscriptions=['general'])
+        instance = self.make_bot(subscribed_streams=['events'])
+        instance.register()
+
+        self.client.get_streams.assert_not_called()
+        self.client.add_subscriptions.assert_called_once_with([{'name': 'events'}])
+
+        instance.process({'type': 'stream', 'op': 'create', 'streams': [{'name': 'new'}]})
+
+        self.client.add_subscriptions.assert_called_once()
+        self.assertEqual({'general', 'events'}, instance.subscriptions)
+
+    def test_registers_without_a_narrow(self):
+        self.client.register.return_value = {'result': 'success', 'queue_id': 'queue-1', 'last_event_id': -1}
+
+        self.assertEqual(('queue-1', -1), self.make_bot().register())
+        self.client.register.assert_called_once_with(bot.Bot.event_types, [])
+
+    def test_rejected_search_narrow_is_dropped(self):
+        self.client.register.side_effect = [
+            {'result': 'error', 'code': 'BAD_REQUEST', 'msg': 'Invalid narrow operator: unknown operator'},
+            {'result': 'success', 'queue_id': 'queue-1', 'last_event_id': -1},
+        ]
+
+        with patch('config.zulip_search_narrow', True):
+            instance = self.make_bot()
+
+        with patch('builtins.print'):
+            self.assertEqual(('queue-1', -1), instance.register())
+
+        self.assertEqual([
+            unittest.mock.call(bot.Bot.event_types, [['search', 'rsvp']]),
+            unittest.mock.call(bot.Bot.event_types, []),
+        ], self.client.register.call_args_list)
+        self.assertEqual([], instance.narrow)
+        self.assertEqual(('queue-1', -1), models.load_zulip_queue('bot@example.com'))
+
+    def listen(self, instance, responses, process=None):
+        """Runs instance.listen() until Zulip has sent every response.
+
+        instance.process is replaced with a mock that calls process, if given.
+
+        Returns the queue that was saved when each get_events call was made,
+        and the ids of the events that were processed.
+        """
+        responses = list(responses)
+        saved = []
+
+        def get_events(queue_id, last_event_id):
+            saved.append(models.load_zulip_queue('bot@example.com'))
+
+            if not responses:
+                raise SystemExit()
+
+            return responses.pop(0)
+
+        self.client.get_events.side_effect = get_events
+
+        with patch.object(instance, 'process', wraps=process) as process, patch('time.sleep'), patch('builtins.print'):
+            self.assertRaises(SystemExit, instance.listen)
+
+        return saved, [call.args[0]['id'] for call in process.call_args_list]
+
+    def test_listen_resumes_saved_queue(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        instance = self.make_bot()
+
+        self.listen(instance, [])
+
+        self.client.register.assert_not_called()
+        self.client.get_streams.assert_not_called()
+        self.client.get_events.assert_called_once_with(queue_id='queue-1', last_event_id=5)
+
+    def test_listen_reregisters_only_when_queue_expired(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        self.client.register.return_value = {'result': 'success', 'queue_id': 'queue-2', 'last_event_id': 10}
+        instance = self.make_bot()
+
+        self.listen(instance, [
+            {'result': 'error', 'code': 'RATE_LIMIT_HIT', 'msg': 'API usage exceeded rate limit'},
+            {'result': 'error', 'code': 'BAD_EVENT_QUEUE_ID', 'msg': 'Bad event queue id: queue-1'},
+        ])
+
+        self.client.register.assert_called_once()
+        self.client.get_streams.assert_called_once()
+        self.assertEqual([
+            unittest.mock.call(queue_id='queue-1', last_event_id=5),
+            unittest.mock.call(queue_id='queue-1', last_event_id=5),
+            unittest.mock.call(queue_id='queue-2', last_event_id=10),
+        ], self.client.get_events.call_args_list)
+
+    def test_listen_saves_last_event_id_after_each_batch(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        instance = self.make_bot()
+
+        saved, processed = self.listen(instance, [
+            {'result': 'success', 'events': [{'id': 6, 'type': 'heartbeat'}, {'id': 7, 'type': 'heartbeat'}]},
+            {'result': 'success', 'events': [{'id': 8, 'type': 'heartbeat'}]},
+        ])
+
+        self.assertEqual([('queue-1', 5), ('queue-1', 7), ('queue-1', 8)], saved)
+        self.assertEqual([
+            unittest.mock.call(queue_id='queue-1', last_event_id=5),
+            unittest.mock.call(queue_id='queue-1', last_event_id=7),
+            unittest.mock.call(queue_id='queue-1', last_event_id=8),
+        ], self.client.get_events.call_args_list)
+        self.assertEqual([6, 7, 8], processed)
+
+    def test_listen_saves_only_handled_messages(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        instance = self.make_bot()
+
+        # The dispatcher isn't started, so message 6 waits for a worker.
+        saved, processed = self.listen(instance, [
+            message_events(zulip_message(6, 'rsvp yes'), zulip_message(7, 'lunch?')),
+            {'result': 'success', 'events': [{'id': 8, 'type': 'heartbeat'}]},
+        ], process=instance.process)
+
+        self.assertEqual([('queue-1', 5), ('queue-1', 5), ('queue-1', 5)], saved)
+        self.assertEqual([6, 7, 8], processed)
+
+        with patch.object(instance, 'respond') as respond:
+            instance.dispatcher.start()
+            instance.dispatcher.stop()
+
+        respond.assert_called_once()
+        self.assertEqual(8, instance.progress.last_handled())
+
+    def test_listen_skips_events_that_fail(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        instance = self.make_bot()
+
+        def process(event):
+            if event['id'] == 6:
+                raise RuntimeError('boom')
+
+        saved, processed = self.listen(instance, [
+            {'result': 'success', 'events': [{'id': 6, 'type': 'heartbeat'}, {'id': 7, 'type': 'heartbeat'}]},
+        ], process=process)
+
+        self.assertEqual([6, 7], processed)
+        self.assertEqual([('queue-1', 5), ('queue-1', 7)], saved)
+
+
+class StopListening(Exception):
+    pass
+
+class FakeAsyncZulipClient:
+    """Plays back Zulip's responses to AsyncBot, then stops it with StopListening."""
+    def __init__(self, responses, registrations=()):
+        self.responses = list(responses)
+        self.registrations = list(registrations)
+        self.registered = []
+        self.fetched = []
+        self.saved = []
+        self.sent = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def register(self, event_types, narrow=None):
+        self.registered.append(narrow)
+        return self.registrations.pop(0)
+
+    async def get_events(self, queue_id, last_event_id):
+        self.fetched.append((queue_id, last_event_id))
+        self.saved.append(models.load_zulip_queue('bot@example.com'))
+
+        if not self.responses:
+            raise StopListening()
+
+        return self.responses.pop(0)
+
+    async def send_message(self, message):
+        self.sent.append(message)
+        return {'result': 'success'}
+
+def zulip_message(message_id, content, subject='Lunch'):
+    return {
+        'id': message_id,
+        'type': 'stream',
+        'display_recipient': 'events',
+        'subject': subject,
+        'sender_email': 'person@example.com',
+        'content': content,
+    }
+
+def message_events(*messages):
+    return {'result': 'success', 'events': [{'id': m['id'], 'type': 'message', 'message': m} for m in messages]}
+
+class AsyncBotTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mock_zulip_client(subscriptions=['events'])
+
+    def tearDown(self):
+        Session.query(models.ZulipQueue).delete()
+        Session.commit()
+
+    def make_bot(self, responses, registrations=()):
+        with patch('zulip.Client', return_value=self.client), patch('config.worker_pool_size', 4):
+            instance = async_runtime.AsyncBot(atom.Atom(True), 'bot@example.com', 'key', 'rsvp', [], 'https://zulip.example.com')
+            self.addCleanup(instance.executor.shutdown)
+            self.addCleanup(instance.db_executor.shutdown)
+
+        instance.async_client = FakeAsyncZulipClient(responses, registrations)
+        return instance
+
+    def run_bot(self, instance, workers=4, queue_depth=100):
+        with patch('config.worker_pool_size', workers), patch('config.worker_queue_depth', queue_depth):
+            self.assertRaises(StopListening, asyncio.run, instance.run())
+
+    def test_no_unused_dispatcher(self):
+        self.assertIsNone(self.make_bot([]).dispatcher)
+
+    def test_listen(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        handled = []
+
+        def handle(message):
+            handled.append(message['id'])
+            return [{'type': 'stream', 'display_recipient': 'events', 'subject': 'Lunch', 'body': 'Done'}]
+
+        instance = self.make_bot([
+            message_events(zulip_message(6, 'rsvp yes'), zulip_message(7, 'lunch?')),
+            message_events(zulip_message(6, 'rsvp yes'), zulip_message(8, 'rsvp no')),
+            {'result': 'success', 'events': [{'id': 9, 'type': 'subscription', 'op': 'add', 'subscriptions': [{'name': 'social'}]}]},
+        ])
+        instance.handle = handle
+
+        self.run_bot(instance)
+
+        self.assertEqual([], instance.async_client.registered)
+        self.client.get_streams.assert_not_called()
+        self.assertEqual([('queue-1', 5), ('queue-1', 7), ('queue-1', 8), ('queue-1', 9)], instance.async_client.fetched)
+        self.assertEqual([6, 8], handled)
+        self.assertEqual([{'type': 'stream', 'subject': 'Lunch', 'to': 'events', 'content': 'Done'}] * 2, instance.async_client.sent)
+        self.assertEqual({'events', 'social'}, instance.subscriptions)
+        self.assertEqual(('queue-1', 9), models.load_zulip_queue('bot@example.com'))
+
+    def test_saves_only_handled_messages(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+
+        def handle(message):
+            if message['id'] == 6:
+                time.sleep(0.2)
+
+            return []
+
+        instance = self.make_bot([
+            message_events(zulip_message(6, 'rsvp yes', subject='Lunch'), zulip_message(7, 'rsvp yes', subject='Dinner')),
+            {'result': 'success', 'events': [{'id': 8, 'type': 'heartbeat'}]},
+        ])
+        instance.handle = handle
+
+        self.run_bot(instance)
+
+        # Message 6 was still being handled when the next two fetches were made.
+        self.assertEqual([('queue-1', 5)] * 3, instance.async_client.saved)
+        self.assertEqual(('queue-1', 8), models.load_zulip_queue('bot@example.com'))
+
+    def test_events_that_fail_are_skipped(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+
+        instance = self.make_bot([
+            {'result': 'success', 'events': [{'id': 6, 'type': 'stream', 'op': 'create', 'streams': [{'name': 'new'}]}]},
+        ])
+        self.client.add_subscriptions.side_effect = RuntimeError('boom')
+
+        with patch('builtins.print'):
+            self.run_bot(instance)
+
+        self.assertEqual([('queue-1', 5), ('queue-1', 6)], instance.async_client.fetched)
+
+    def test_messages_in_a_thread_are_handled_in_order(self):
+        handled = []
+
+        def handle(message):
+            if message['id'] == 1:
+                time.sleep(0.1)
+
+            handled.append(message['id'])
+            return []
+
+        instance = self.make_bot([message_events(
+            zulip_message(1, 'rsvp yes', subject='Lunch'),
+            zulip_message(2, 'rsvp no', subject='Lunch'),
+            zulip_message(3, 'rsvp yes', subject='Dinner'),
+        )], registrations=[{'result': 'success', 'queue_id': 'queue-1', 'last_event_id': 0}])
+        instance.handle = handle
+
+        self.run_bot(instance)
+
+        # Dinner doesn't wait for Lunch, but Lunch's messages wait for each other.
+        self.assertEqual([3, 1, 2], handled)
+        self.assertEqual({}, instance.tails)
+
+    def test_messages_in_flight_are_limited(self):
+        lock = threading.Lock()
+        in_flight = []
+        most_in_flight = []
+
+        def handle(message):
+            with lock:
+                in_flight.append(message['id'])
+                most_in_flight.append(len(in_flight))
+
+            time.sleep(0.05)
+
+            with lock:
+                in_flight.remove(message['id'])
+
+            return []
+
+        instance = self.make_bot([
+            message_events(*[zulip_message(i, 'rsvp yes', subject='Thread {}'.format(i)) for i in range(1, 7)]),
+        ], registrations=[{'result': 'success', 'queue_id': 'queue-1', 'last_event_id': 0}])
+        instance.handle = handle
+
+        # The executor has four threads, but only two messages may be in flight.
+        self.run_bot(instance, workers=1, queue_depth=2)
+
+        self.assertEqual(6, len(most_in_flight))
+        self.assertEqual(2, max(most_in_flight))
+
+    def test_expired_queue_is_registered_again(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+
+        instance = self.make_bot([
+            {'result': 'error', 'code': 'BAD_EVENT_QUEUE_ID', 'msg': 'Bad event queue id: queue-1'},
+        ], registrations=[{'result': 'success', 'queue_id': 'queue-2', 'last_event_id': 10}])
+
+        with patch('builtins.print'):
+            self.run_bot(instance)
+
+        self.assertEqual([[]], instance.async_client.registered)
+        self.client.get_streams.assert_called_once()
+        self.assertEqual([('queue-1', 5), ('queue-2', 10)], instance.async_client.fetched)
+        self.assertEqual(('queue-2', 10), models.load_zulip_queue('bot@example.com'))
+
+    def test_replies_are_traced(self):
+        def handle(message):
+            with tracing.span('db', 'SELECT'):
+                pass
+
+            return [{'type': 'stream', 'display_recipient': 'events', 'subject': 'Lunch', 'body': 'Done'}]
+
+        instance = self.make_bot([message_events(zulip_message(6, 'rsvp yes'))],
+                                 registrations=[{'result': 'success', 'queue_id': 'queue-1', 'last_event_id': 0}])
+        instance.handle = handle
+
+        with patch('config.trace_file', '-'), patch('tracing.write') as write:
+            self.run_bot(instance)
+
+        lines = [args[0] for args, _ in write.call_args_list]
+        self.assertEqual([('db', 'SELECT'), ('zulip', 'send_message')], [(l['category'], l['name']) for l in lines if l['kind'] == 'span'])
+
+        [trace] = [l for l in lines if l['kind'] == 'trace']
+        self.assertEqual(6, trace['message_id'])
+        self.assertEqual({'db', 'zulip'}, set(trace['breakdown']))
+
+    def run_role(self, role, crashes=0):
+        """Runs run_async with everything it starts mocked out, and the event loop crashing crashes times."""
+        running = atom.Atom(True)
+
+        def run(coroutine):
+            nonlocal crashes
+
+            if crashes:
+                crashes -= 1
+                raise RuntimeError('crash')
+
+            running.value = False
+
+        with patch('async_runtime.AsyncBot') as AsyncBot, \
+                patch('async_runtime.run_outbox_async', new_callable=unittest.mock.Mock) as run_outbox_async, \
+                patch('async_runtime.run_poller_async', new_callable=unittest.mock.Mock) as run_poller_async, \
+                patch('async_runtime.main', new_callable=unittest.mock.Mock) as main, \
+                patch('poller.make_scheduler') as make_scheduler, \
+                patch('poller.listen_for_refreshes') as listen_for_refreshes, \
+                patch('asyncio.run', side_effect=run), patch('builtins.print'):
+            self.assertRaises(SystemExit, async_runtime.run_async, running, role)
+
+        return {
+            'bot': AsyncBot.call_count,
+            'bot runs': AsyncBot.return_value.run.call_count,
+            'bot shutdowns': AsyncBot.return_value.shutdown.call_count,
+            'outbox': run_outbox_async.call_count,
+            'schedulers': make_scheduler.call_count,
+            'listeners': listen_for_refreshes.call_count,
+            'poller': run_poller_async.call_count,
+            'loops': main.call_count,
+        }
+
+    def test_roles(self):
+        self.assertEqual({'bot': 1, 'bot runs': 1, 'bot shutdowns': 1, 'outbox': 1, 'schedulers': 1, 'listeners': 1, 'poller': 1, 'loops': 1}, self.run_role('all'))
+        self.assertEqual({'bot': 1, 'bot runs': 1, 'bot shutdowns': 1, 'outbox': 1, 'schedulers': 0, 'listeners': 0, 'poller': 0, 'loops': 1}, self.run_role('bot'))
+        self.assertEqual({'bot': 0, 'bot runs': 0, 'bot shutdowns': 0, 'outbox': 0, 'schedulers': 1, 'listeners': 1, 'poller': 1, 'loops': 1}, self.run_role('poller'))
+
+    def test_restarts_reuse_the_bot_and_listener(self):
+        self.assertEqual({'bot': 1, 'bot runs': 3, 'bot shutdowns': 1, 'outbox': 3, 'schedulers': 1, 'listeners': 1, 'poller': 3, 'loops': 3}, self.run_role('all', crashes=2))
+
+    def test_refresh_listener_stops(self):
+        with patch('poller.listen_for_refreshes') as listen_for_refreshes, \
+                patch('poller.make_scheduler'), patch('async_runtime.main', new_callable=unittest.mock.Mock), patch('builtins.print'):
+            self.assertRaises(SystemExit, async_runtime.run_async, atom.Atom(False), 'poller')
+
+        [listening, _], _ = listen_for_refreshes.call_args
+        self.assertFalse(listening.value)
+
+class ZulipQueueTest(unittest.TestCase):
+    def tearDown(self):
+        Session.query(models.ZulipQueue).delete()
+        Session.commit()
+
+    def test_no_saved_queue(self):
+        self.assertIsNone(models.load_zulip_queue('bot@example.com'))
+
+    def test_save_and_resume(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        models.save_zulip_queue('bot@example.com', 'queue-1', 9)
+        models.save_zulip_queue('other-bot@example.com', 'queue-2', 1)
+
+        self.assertEqual(('queue-1', 9), models.load_zulip_queue('bot@example.com'))
+        self.assertEqual(('queue-2', 1), models.load_zulip_queue('other-bot@example.com'))
+
+
+class SessionScopeTest(unittest.TestCase):
+    def setUp(self):
+        models.save_zulip_queue('bot@example.com', 'queue-1', 5)
+        models.save_zulip_queue('other-bot@example.com', 'queue-2', 1)
+
+    def tearDown(self):
+        Session.query(models.ZulipQueue).delete()
+        Session.commit()
+
+    def test_removes_the_session(self):
+        with models.session_scope('test'):
+            session = Session()
+            queue = Session.get(models.ZulipQueue, 'bot@example.com')
+            queue.last_event_id = 100
+
+        self.assertIsNot(session, Session())
+        self.assertEqual(0, len(Session().identity_map))
+        self.assertEqual(('queue-1', 5), models.load_zulip_queue('bot@example.com'))
+
+    def test_reports_identity_map_size(self):
+        with patch('config.trace_file', '-'), \
+                patch('tracing.write') as write, \
+                patch('models.identity_map_sizes', models.IdentityMapSizes()), \
+                patch('builtins.print') as mock_print:
+            with tracing.trace('message'), models.session_scope('message'):
+                queues = Session.query(models.ZulipQueue).all()
+
+            with models.session_scope('message'):
+                queue = Session.get(models.ZulipQueue, 'bot@example.com')
+
+        [args], _ = write.call_args
+        self.assertEqual(2, args['identity_map_size'])
+        mock_print.assert_called_once_with("Largest identity map for a message so far: 2 objects")
+
+    def test_bot_handles_messages_in_a_scope(self):
+        loaded = []
+
+        def process_message(message):
+            loaded.append(Session.get(models.ZulipQueue, 'bot@example.com'))
+            return [len(Session().identity_map)]
+
+        instance = unittest.mock.Mock(rsvp=unittest.mock.Mock())
+        instance.rsvp.process_message.side_effect = process_message
+
+        self.assertEqual([1], bot.Bot.handle(instance, {'content': 'rsvp yes'}))
+        self.assertEqual(0, len(Session().identity_map))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = cache.LRUCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_and_set(self):
+        self.cache.set('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIn('a', self.cache)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.now = 9
+        self.assertIn('a', self.cache)
+        self.now = 10
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(0, len(self.cache))
+
+    def test_falsy_values(self):
+        self.cache.set('a', None)
+        self.assertIn('a', self.cache)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.runs = []
+
+    def job(self, name, interval, result=None):
+        def run():
+            self.runs.append((name, self.now))
+
+            if isinstance(result, Exception):
+                raise result
+
+            return result
+
+        return scheduler.Job(name, run, interval)
+
+    def run_until(self, jobs, until):
+        while self.now <= until:
+            jobs.run_due()
+            self.now += jobs.seconds_until_next() or 1
+
+    def make_scheduler(self, *jobs, random=lambda: 0.5):
+        return scheduler.Scheduler(list(jobs), jitter=0.1, max_backoff=100, clock=lambda: self.now, random=random)
+
+    def test_jobs_run_on_their_own_schedules(self):
+        jobs = self.make_scheduler(self.job('fast', 10), self.job('slow', 25))
+        self.run_until(jobs, 50)
+
+        self.assertEqual([0, 10, 20, 30, 40, 50], [at for name, at in self.runs if name == 'fast'])
+        self.assertEqual([0, 25, 50], [at for name, at in self.runs if name == 'slow'])
+
+    def test_jobs_choose_their_next_interval(self):
+        jobs = self.make_scheduler(self.job('adaptive', 10, result=30))
+        self.run_until(jobs, 70)
+
+        self.assertEqual([0, 30, 60], [at for name, at in self.runs])
+
+    def test_failures_back_off(self):
+        failing = self.job('failing', 10, result=RuntimeError('RC is down'))
+        jobs = self.make_scheduler(failing)
+
+        with patch('builtins.print'):
+            self.run_until(jobs, 400)
+
+        self.assertEqual([0, 20, 60, 140, 240, 340], [at for name, at in self.runs])
+
+        failing.run = lambda: self.runs.append(('failing', self.now))
+        self.run_until(jobs, 460)
+        self.assertEqual(0, failing.failures)
+        self.assertEqual([440, 450, 460], [at for name, at in self.runs[6:]])
+
+    def test_run_soon(self):
+        jobs = self.make_scheduler(self.job('a', 10), self.job('b', 10))
+        jobs.run_due()
+
+        self.now = 3
+        jobs.run_soon('b')
+        self.assertEqual(0, jobs.seconds_until_next())
+
+        jobs.run_due()
+        self.assertEqual([('a', 0), ('b', 0), ('b', 3)], self.runs)
+
+    def test_jitter(self):
+        shortest = self.make_scheduler(self.job('a', 10), random=lambda: 0)
+        shortest.run_due()
+        self.assertAlmostEqual(9, shortest.seconds_until_next())
+
+        longest = self.make_scheduler(self.job('a', 10), random=lambda: 1)
+        longest.run_due()
+        self.assertAlmostEqual(11, longest.seconds_until_next())
+
+
+class ProcessedMessagesTest(unittest.TestCase):
+    def tearDown(self):
+        Session.query(models.ProcessedMessage).delete()
+        Session.commit()
+
+    def test_in_memory(self):
+        processed = dedup.ProcessedMessages(maxsize=100, ttl=60)
+
+        self.assertTrue(processed.first_time(1))
+        self.assertFalse(processed.first_time(1))
+        self.assertTrue(processed.first_time(2))
+
+    def test_persisted_across_restarts(self):
+        before_restart = dedup.ProcessedMessages(maxsize=100, ttl=60, persist=True)
+        after_restart = dedup.ProcessedMessages(maxsize=100, ttl=60, persist=True)
+
+        self.assertTrue(before_restart.first_time(1))
+        self.assertFalse(after_restart.first_time(1))
+        self.assertTrue(after_restart.first_time(2))
+
+
+class DispatcherTest(unittest.TestCase):
+    def test_same_key_runs_in_order(self):
+        handled = []
+        d = dispatcher.Dispatcher(handled.append, workers=4)
+        d.start()
+
+        for i in range(100):
+            d.submit('thread', i)
+
+        d.stop()
+
+        self.assertEqual(list(range(100)), handled)
+
+    def test_different_keys_run_in_parallel(self):
+        fast_done = threading.Event()
+        slow_saw_fast = []
+
+        def handle(item):
+            if item == 'slow':
+                slow_saw_fast.append(fast_done.wait(5))
+            else:
+                fast_done.set()
+
+        d = dispatcher.Dispatcher(handle, workers=2)
+        d.start()
+
+        # Pick two keys that land on different workers.
+        even = next(k for k in range(10) if hash(k) % 2 == 0)
+        odd = next(k for k in range(10) if hash(k) % 2 == 1)
+        d.submit(even, 'slow')
+        d.submit(odd, 'fast')
+        d.stop()
+
+        self.assertEqual([True], slow_saw_fast)
+
+    def test_handler_errors_dont_stop_the_worker(self):
+        handled = []
+
+        def handle(item):
+            if item == 'bad':
+                raise RuntimeError('oops')
+            handled.append(item)
+
+        d = dispatcher.Dispatcher(handle, workers=1)
+        d.start()
+
+        with patch('builtins.print'):
+            for item in ['a', 'bad', 'b']:
+                d.submit('thread', item)
+
+            d.stop()
+
+        self.assertEqual(['a', 'b'], handled)
+
+
+class DatabaseConfigTest(unittest.TestCase):
+    def test_engine_settings(self):
+        self.assertEqual(config.db_pool_size, models.engine.pool.size())
+        self.assertEqual(config.db_max_overflow, models.engine.pool._max_overflow)
+
+        timeout = Session.execute(models.sqlalchemy.text("SELECT setting FROM pg_settings WHERE name = 'statement_timeout'")).scalar()
+        Session.commit()
+        self.assertEqual(config.db_statement_timeout, int(timeout))
+
+    def test_slow_queries_are_logged(self):
+        with patch('config.db_slow_query_ms', 0), patch('builtins.print') as mock_print:
+            Session.execute(models.sqlalchemy.text('SELECT 1'))
+            Session.commit()
+
+        [args], _ = mock_print.call_args
+        self.assertRegex(args, r'^Slow query \([\d.]+ ms\): SELECT 1$')
+
+    def test_fast_queries_are_not_logged(self):
+        with patch('config.db_slow_query_ms', 60 * 1000), patch('builtins.print') as mock_print:
+            Session.execute(models.sqlalchemy.text('SELECT 1'))
+            Session.commit()
+
+        mock_print.assert_not_called()
+
+    def test_failed_statements_dont_leave_timers_behind(self):
+        with self.assertRaises(models.sqlalchemy.exc.ProgrammingError):
+            Session.execute(models.sqlalchemy.text('SELECT * FROM no_such_table'))
+        Session.rollback()
+
+        conn = Session.connection()
+        self.assertEqual([], conn.info.get('statement_started', []))
+        Session.commit()
+
+
+class TracingTest(RSVPTest):
+    def trace_lines(self, f):
+        with tempfile.NamedTemporaryFile('r') as trace_file, \
+                patch('config.trace_file', trace_file.name), \
+                patch('tracing._output', None):
+            try:
+                f()
+            finally:
+                if tracing._output is not None:
+                    tracing._output.close()
+
+            return [json.loads(line) for line in trace_file]
+
+    def test_message_trace(self):
+        def handle_message():
+            with tracing.trace('message', message_id=42):
+                self.issue_command('rsvp yes')
+
+        lines = self.trace_lines(handle_message)
+        trace = lines[-1]
+        spans = lines[:-1]
+
+        self.assertEqual('trace', trace['kind'])
+        self.assertEqual(42, trace['message_id'])
+        self.assertTrue(all(span['message_id'] == 42 for span in spans))
+        self.assertEqual({'db', 'rc', 'command'}, set(trace['breakdown']))
+
+        [command] = trace['commands']
+        self.assertEqual('RSVPConfirmCommand', command['name'])
+        self.assertIn('rc', command['breakdown'])
+        self.assertIn('db', command['breakdown'])
+        self.assertIn('POST events/{}/join'.format(self.event.recurse_id), [span['name'] for span in spans])
+
+    def test_no_output_outside_a_trace(self):
+        self.assertEqual([], self.trace_lines(lambda: self.issue_command('rsvp yes')))
+
 
 @contextmanager
 def devserver(port):
@@ -0,0 +1,167 @@
+"""Lightweight tracing for finding out where the time goes.
+
+A trace covers one unit of work, like handling a Zulip message or running a
+poll cycle. Inside a trace, spans time individual calls to the database, RC
+and Zulip. Spans nest: the time spent in a span is also added to the
+breakdown of every span it happened inside of, so a command's span says how
+much of its time went to each of the db, rc and zulip categories.
+
+The current trace is kept in a context variable, so every thread and every
+asyncio task has its own.
+
+Tracing is off unless RSVPBOT_TRACE_FILE is set. Every finished span and
+trace is written to that file ('-' means stdout) as one JSON object per line.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import contextvars
+import datetime
+import json
+import sys
+import threading
+import time
+
+import config
+
+_current = contextvars.ContextVar('trace', default=None)
+_write_lock = threading.Lock()
+_output = None
+
+
+def enabled():
+    return config.trace_file is not None
+
+def current_trace():
+    return _current.get()
+
+
+class Span:
+    def __init__(self, category, name, attrs):
+        self.category = category
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.breakdown = defaultdict(float)
+
+
+class Trace(Span):
+    def __init__(self, name, attrs):
+        super().__init__('trace', name, attrs)
+        self.stack = [self]
+        self.commands = []
+        self.summary = {}
+
+    def finish_span(self, span, duration_ms, error=None):
+        # self.stack holds this span's ancestors, all the way up to the trace
+        for ancestor in self.stack:
+            ancestor.breakdown[span.category] += duration_ms
+
+        line = {
+            'kind': 'span',
+            'trace': self.name,
+            'category': span.category,
+            'name': span.name,
+            'duration_ms': round(duration_ms, 3),
+            **self.attrs,
+            **span.attrs,
+        }
+
+        if span.breakdown:
+            line['breakdown'] = rounded(span.breakdown)
+
+        if error is not None:
+            line['error'] = error
+
+        if span.category == 'command':
+            self.commands.append({'name': span.name, 'duration_ms': line['duration_ms'], 'breakdown': line.get('breakdown', {})})
+
+        write(line)
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Starts a trace. attrs (like message_id) are added to every line it writes."""
+    if not enabled() or current_trace() is not None:
+        yield
+        return
+
+    t = Trace(name, attrs)
+    token = _current.set(t)
+    error = None
+
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        duration_ms = (time.perf_counter() - t.started) * 1000
+
+        line = {
+            'kind': 'trace',
+            'trace': name,
+            'duration_ms': round(duration_ms, 3),
+            **attrs,
+            'breakdown': rounded(t.breakdown),
+            'commands': t.commands,
+            **t.summary,
+        }
+
+        if error is not None:
+            line['error'] = error
+
+        write(line)
+
+@contextmanager
+def span(category, name, **attrs):
+    """Times the body of the with statement, if we're inside a trace."""
+    t = current_trace()
+
+    if t is None:
+        yield
+        return
+
+    s = Span(category, name, attrs)
+    t.stack.append(s)
+    error = None
+
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        t.stack.pop()
+        t.finish_span(s, (time.perf_counter() - s.started) * 1000, error)
+
+def annotate(**attrs):
+    """Adds attrs to the line written when the current trace finishes, if there is one."""
+    t = current_trace()
+
+    if t is not None:
+        t.summary.update(attrs)
+
+def record(category, name, duration_ms, **attrs):
+    """Records a span that has already finished, for code that can't use span()."""
+    t = current_trace()
+
+    if t is not None:
+        t.finish_span(Span(category, name, attrs), duration_ms)
+
+
+def rounded(breakdown):
+    return {category: round(ms, 3) for category, ms in breakdown.items()}
+
+def write(line):
+    global _output
+
+    line = {'ts': datetime.datetime.utcnow().isoformat() + 'Z', **line}
+    text = json.dumps(line, default=str) + '\n'
+
+    with _write_lock:
+        if _output is None:
+            _output = sys.stdout if config.trace_file == '-' else open(config.trace_file, 'a')
+
+        _output.write(text)
+        _output.flush()
@@ -0,0 +1,131 @@
+"""Receives event-changed webhooks from RC, enabled with RSVPBOT_WEBHOOK_PORT.
+
+RC POSTs {"action": ..., "event": {...}} to /rc/webhook whenever an event is
+created, updated, joined or left, signed with an HMAC-SHA256 of the body in
+X-RC-Signature. The event is applied the same way the poller applies what it
+fetches, so a change shows up in a second instead of at the next poll. The
+poller keeps running, slowly, to catch anything a webhook missed.
+"""
+from datetime import datetime
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import sys
+import threading
+import traceback
+
+import pytz
+
+import config
+import models
+import tracing
+from models import Event, Session
+
+WEBHOOK_PATH = '/rc/webhook'
+
+# A webhook carries a single event, so anything bigger isn't from RC. Checked
+# before the body is read, since the signature can't be checked until it is.
+MAX_BODY_SIZE = 64 * 1024
+
+# Webhooks are applied one at a time, so however many arrive together, the
+# receiver only needs one database connection (see config.db_pool_size).
+apply_lock = threading.Lock()
+
+def utcnow():
+    return datetime.utcnow().replace(tzinfo=pytz.utc)
+
+def sign(body, secret):
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+def valid_signature(body, signature):
+    return signature is not None and hmac.compare_digest(sign(body, config.webhook_secret), signature)
+
+def apply_event(e):
+    """Applies an event RC says has changed. Returns what was done to it."""
+    event = Session.query(Event).filter(Event.recurse_id == e['id']).one_or_none()
+
+    if event is None:
+        # Like the poller, only pick up events that haven't started yet.
+        if models.parse_time(e, 'start_time') <= utcnow():
+            return 'ignored'
+
+        inserted = models.insert_new_events([e])
+        Session.commit()
+        return 'created' if inserted else 'unchanged'
+
+    if event.rc_fingerprint == models.rc_fingerprint(e):
+        return 'unchanged'
+
+    models.assign_attributes(event, models.api_attributes(e))
+    Session.commit()
+    return 'updated'
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self.respond(404, {'result': 'not_found'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+
+        if not 0 <= length <= MAX_BODY_SIZE:
+            # Don't leave the unread body on a connection we'd keep alive.
+            self.close_connection = True
+            return self.respond(413 if length > MAX_BODY_SIZE else 400, {'result': 'bad_length'})
+
+        body = self.rfile.read(length)
+
+        if not valid_signature(body, self.headers.get('X-RC-Signature')):
+            return self.respond(401, {'result': 'bad_signature'})
+
+        try:
+            payload = json.loads(body)
+            e = payload['event']
+        except (ValueError, KeyError, TypeError):
+            return self.respond(400, {'result': 'bad_payload'})
+
+        with apply_lock, tracing.trace('webhook', action=payload.get('action'), recurse_id=e.get('id')), models.session_scope('webhook'):
+            try:
+                result = apply_event(e)
+            except Exception:
+                print(traceback.format_exc())
+                Session.rollback()
+                return self.respond(500, {'result': 'error'})
+
+        self.respond(200, {'result': result})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Failures are printed by do_POST; don't log every request.
+        pass
+
+def make_server(port):
+    server = ThreadingHTTPServer(('', port), WebhookHandler)
+    server.daemon_threads = True
+    # handle_request returns after this many seconds, so run_webhooks notices shutdowns.
+    server.timeout = 1
+    return server
+
+def run_webhooks(running):
+    server = make_server(config.webhook_port)
+    print("Listening for RC webhooks on port {}".format(config.webhook_port))
+
+    try:
+        while running.value:
+            server.handle_request()
+    finally:
+        server.server_close()
+
+    print("Quitting webhooks")
+    sys.exit()
@@ -3,6 +3,7 @@ import zulip
 
 import config
 import strings
+import tracing
 import util
 
 
@@ -13,9 +14,9 @@ def make_client():
         site=config.zulip_site
     )
 
-def announce_event(event):
-    client = make_client()
-    client.send_message({
+def announce_message(event):
+    """The send_message payload announcing a new event in the announce thread."""
+    return {
         "type": "stream",
         "to": config.rsvpbot_stream,
         "subject": config.rsvpbot_announce_subject,
@@ -26,29 +27,37 @@ def announce_event(event):
             timestamp=event.timestamp(),
             created_by=event.created_by
         )
-    })
+    }
 
 def get_names(ids):
     client = make_client()
-    all_users = client.get_members()['members']
+
+    with tracing.span('zulip', 'get_members'):
+        all_users = client.get_members()['members']
+
     name_mapping = {user['user_id']: user['full_name'] for user in all_users}
     return [name_mapping[id] for id in ids]
 
 
-def send_message(msg, client=None):
-    """Sends a message to zulip stream or user."""
-    if client is None:
-        client = make_client()
-
+def outgoing_message(msg):
+    """Converts a reply from RSVP.process_message into a Zulip send_message payload."""
     msg_to = msg['display_recipient']
     if msg['type'] == 'private':
         msg_to = msg.get('sender_email') or msg_to
 
-    client.send_message({
+    return {
         "type": msg['type'],
         "subject": msg["subject"],
         "to": msg_to,
         "content": msg['body']
-    })
+    }
+
+def send_message(msg, client=None):
+    """Sends a message to zulip stream or user."""
+    if client is None:
+        client = make_client()
+
+    with tracing.span('zulip', 'send_message'):
+        client.send_message(outgoing_message(msg))
 
 stream_topic_to_narrow_url = util.stream_topic_to_narrow_url